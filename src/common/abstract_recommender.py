@@ -6,6 +6,41 @@ import numpy as np
 import torch
 import torch.nn as nn
 
+# memory-mapped CPU features loaded in this process, shared by every model instance (e.g. the runs of a
+# grid search); device copies belong to the model, so they are freed once it compresses or drops them
+_feature_cache = {}
+
+
+def load_feature(path, device):
+    r"""Load a feature matrix as float32 memory-mapped from a plain ``.npy``, so pages are only read
+    when first touched. Pickled or non-float32 files are converted once to a ``.f32.npy`` next to them.
+    Features are frozen: on CPU the returned tensor is shared between calls and must not be modified in place,
+    on another device every call makes its own copy of the shared memory map.
+
+    Args:
+        path (str): ``.npy`` feature file
+        device (torch.device): device of the returned tensor
+
+    Returns:
+        torch.Tensor: features, shape: [n_items, dim]
+    """
+    key = os.path.abspath(path)
+    if key not in _feature_cache:
+        f32_path = os.path.splitext(path)[0] + '.f32.npy'
+        if os.path.isfile(f32_path) and os.path.getmtime(f32_path) >= os.path.getmtime(path):
+            path = f32_path
+        try:
+            feat = np.load(path, mmap_mode='c')
+        except ValueError:
+            # object arrays cannot be memory-mapped
+            feat = None
+        if feat is None or feat.dtype != np.float32:
+            feat = np.load(path, allow_pickle=True).astype(np.float32)
+            np.save(f32_path, feat)
+            feat = np.load(f32_path, mmap_mode='c')
+        _feature_cache[key] = torch.from_numpy(feat)
+    return _feature_cache[key].to(device)
+
 
 class AbstractRecommender(nn.Module):
     r"""Base class for all models
@@ -67,6 +102,69 @@ class AbstractRecommender(nn.Module):
         params = sum([np.prod(p.size()) for p in model_parameters])
         return super().__str__() + '\nTrainable parameters: {}'.format(params)
 
+    def memory_report(self, optimizer=None):
+        r"""Memory of every parameter, buffer and tensor attribute of the model, largest first.
+
+        A parameter that requires grad but has no ``.grad`` was not used by the last backward pass and is
+        flagged ``UNUSED``; call after a training step whose gradients were reset with
+        ``zero_grad(set_to_none=True)``, as the trainer does, and before the next ``zero_grad``.
+
+        Args:
+            optimizer (torch.optim.Optimizer): adds the bytes of its state of every parameter
+
+        Returns:
+            str: one line per tensor and totals
+        """
+        rows, seen = [], set()
+        for name, p in self.named_parameters():
+            seen.add(id(p))
+            state = optimizer.state.get(p, {}) if optimizer is not None else {}
+            optim_bytes = sum(tensor_nbytes(v) for v in state.values() if torch.is_tensor(v))
+            grad = 'yes' if p.grad is not None else ('UNUSED' if p.requires_grad else 'frozen')
+            rows.append(('param', name, p, grad, optim_bytes))
+        for name, b in self.named_buffers():
+            seen.add(id(b))
+            rows.append(('buffer', name, b, '-', 0))
+        for prefix, module in self.named_modules():
+            for attr, value in vars(module).items():
+                if (torch.is_tensor(value) or callable(getattr(value, 'nbytes', None))) and id(value) not in seen:
+                    seen.add(id(value))
+                    rows.append(('tensor', prefix + '.' + attr if prefix else attr, value, '-', 0))
+        rows.sort(key=lambda r: tensor_nbytes(r[2]) + r[4], reverse=True)
+
+        mb = lambda n: '{:.2f}MB'.format(n / 2 ** 20)
+        lines = ['{:<7} {:<40} {:<18} {:<14} {:>12} {:>7} {:>12}'.format(
+            'kind', 'name', 'shape', 'dtype', 'bytes', 'grad', 'optim')]
+        totals = {'param': 0, 'buffer': 0, 'tensor': 0, 'grad': 0, 'optim': 0}
+        for kind, name, t, grad, optim_bytes in rows:
+            nbytes = tensor_nbytes(t)
+            dtype = str(t.dtype).replace('torch.', '') if torch.is_tensor(t) else type(t).__name__
+            lines.append('{:<7} {:<40} {:<18} {:<14} {:>12} {:>7} {:>12}'.format(
+                kind, name, str(tuple(t.shape)), dtype, mb(nbytes), grad, mb(optim_bytes)))
+            totals[kind] += nbytes
+            totals['optim'] += optim_bytes
+            if kind == 'param' and t.grad is not None:
+                totals['grad'] += tensor_nbytes(t.grad)
+        unused = [r[1] for r in rows if r[3] == 'UNUSED']
+        lines.append('total: parameters {}, gradients {}, optimizer state {}, buffers {}, other tensors {}'.format(
+            mb(totals['param']), mb(totals['grad']), mb(totals['optim']), mb(totals['buffer']), mb(totals['tensor'])))
+        lines.append('unused parameters ({}): {}'.format(
+            mb(sum(tensor_nbytes(r[2]) for r in rows if r[3] == 'UNUSED')), ', '.join(unused) or 'none'))
+        return '\n'.join(lines)
+
+
+def tensor_nbytes(t):
+    r"""Bytes held by a dense or sparse (COO/CSR) tensor, or by an object with an ``nbytes()`` method."""
+    if not torch.is_tensor(t):
+        return t.nbytes()
+    if t.layout == torch.sparse_coo:
+        parts = (t._indices(), t._values())
+    elif t.layout == torch.sparse_csr:
+        parts = (t.crow_indices(), t.col_indices(), t.values())
+    else:
+        parts = (t,)
+    return sum(part.numel() * part.element_size() for part in parts)
+
 
 class GeneralRecommender(AbstractRecommender):
     """This is a abstract general recommender. All the general model should implement this class.
@@ -94,10 +192,8 @@ class GeneralRecommender(AbstractRecommender):
             v_feat_file_path = os.path.join(dataset_path, config['vision_feature_file'])
             t_feat_file_path = os.path.join(dataset_path, config['text_feature_file'])
             if os.path.isfile(v_feat_file_path):
-                self.v_feat = torch.from_numpy(np.load(v_feat_file_path, allow_pickle=True)).type(torch.FloatTensor).to(
-                    self.device)
+                self.v_feat = load_feature(v_feat_file_path, self.device)
             if os.path.isfile(t_feat_file_path):
-                self.t_feat = torch.from_numpy(np.load(t_feat_file_path, allow_pickle=True)).type(torch.FloatTensor).to(
-                    self.device)
+                self.t_feat = load_feature(t_feat_file_path, self.device)
 
             assert self.v_feat is not None or self.t_feat is not None, 'Features all NONE'
@@ -59,4 +59,70 @@ class L2Loss(nn.Module):
         l2_loss = torch.zeros(1).to(embeddings[-1].device)
         for embedding in embeddings:
             l2_loss += torch.sum(embedding**2)*0.5
-        return l2_loss
\ No newline at end of file
+        return l2_loss
+
+class _BlockDiagLogSoftmax(torch.autograd.Function):
+    """ -mean(diag(log_softmax(view1 @ view2.T / t))) over (block x block) tiles.
+
+    Forward keeps an online log-sum-exp per row, backward recomputes each tile from the saved row
+    log-sum-exp instead of storing the (N x N) score matrix.
+    """
+    @staticmethod
+    def forward(ctx, view1, view2, temperature, block_size):
+        n = view1.shape[0]
+        lse = view1.new_empty(n)
+        for start in range(0, n, block_size):
+            rows = view1[start:start + block_size]
+            row_max = rows.new_full((rows.shape[0],), float('-inf'))
+            row_sum = rows.new_zeros(rows.shape[0])
+            for c_start in range(0, n, block_size):
+                tile = rows @ view2[c_start:c_start + block_size].T / temperature
+                new_max = torch.maximum(row_max, tile.max(dim=1)[0])
+                row_sum = row_sum * torch.exp(row_max - new_max) + torch.exp(tile - new_max[:, None]).sum(dim=1)
+                row_max = new_max
+            lse[start:start + block_size] = row_max + torch.log(row_sum)
+        diag = (view1 * view2).sum(dim=1) / temperature
+        ctx.save_for_backward(view1, view2, lse)
+        ctx.temperature = temperature
+        ctx.block_size = block_size
+        return (lse - diag).mean()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        view1, view2, lse = ctx.saved_tensors
+        temperature, block_size = ctx.temperature, ctx.block_size
+        n = view1.shape[0]
+        grad1 = -view2.clone()
+        grad2 = -view1.clone()
+        for start in range(0, n, block_size):
+            rows = view1[start:start + block_size]
+            for c_start in range(0, n, block_size):
+                cols = view2[c_start:c_start + block_size]
+                prob = torch.exp(rows @ cols.T / temperature - lse[start:start + block_size, None])
+                grad1[start:start + block_size] += prob @ cols
+                grad2[c_start:c_start + block_size] += prob.T @ rows
+        scale = grad_output / (n * temperature)
+        return grad1 * scale, grad2 * scale, None, None
+
+
+class BlockSolosimLoss(nn.Module):
+
+    """ BlockSolosimLoss, exact Solosimloss (Eq.16) with memory bounded by the block size
+
+    Gives the same loss and gradients as ``-diag(log_softmax(view1 @ view2.T / t)).mean()``, but the
+    score matrix is only ever materialized one (block_size x block_size) tile at a time.
+
+    Args:
+        - block_size(int): rows/columns per tile
+
+    Shape:
+        - View1: (N, D)
+        - View2: (N, D), same shape as the View1
+        - Output: scalar.
+    """
+    def __init__(self, block_size=4096):
+        super(BlockSolosimLoss, self).__init__()
+        self.block_size = block_size
+
+    def forward(self, view1, view2, temperature):
+        return _BlockDiagLogSoftmax.apply(view1, view2, temperature, self.block_size)
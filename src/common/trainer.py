@@ -6,6 +6,7 @@ r"""
 """
 
 import os
+import copy
 import itertools
 import torch
 import torch.optim as optim
@@ -16,7 +17,7 @@ import matplotlib.pyplot as plt
 from time import time
 from logging import getLogger
 
-from utils.utils import get_local_time, early_stopping, dict2str
+from utils.utils import get_local_time, early_stopping, dict2str, compile_fn, compile_warm_up
 from utils.topk_evaluator import TopKEvaluator
 import wandb
 
@@ -94,6 +95,27 @@ class Trainer(AbstractTrainer):
 
         self.club = club
         self.optimizer_D = optim.Adam(self.club.parameters(), lr=self.learning_rate)
+        # CLUB critic schedule: club_steps updates every club_interval batches, on club_batch_size items
+        # (None: all items, 0 steps: no critic updates); club_fused merges the club_steps mini-batches into a
+        # single update, so it needs club_batch_size to bound its size
+        self.club_steps = 50 if config['club_steps'] is None else config['club_steps']
+        self.club_interval = config['club_interval'] or 1
+        self.club_batch_size = config['club_batch_size']
+        self.club_fused = config['club_fused']
+        if self.club_fused and not self.club_batch_size:
+            raise ValueError('club_fused needs club_batch_size, otherwise one update holds club_steps x n_items rows')
+        self.club_stats = None
+        # 'bf16': forward pass under bfloat16 autocast (CPU or CUDA), weights and optimizer states stay fp32
+        self.mixed_precision = config['mixed_precision']
+        self.amp_device = torch.device(self.device).type
+        self.train_samples = 0
+        # log AbstractRecommender.memory_report after the first training epoch
+        self.memory_report = config['memory_report']
+        # torch.compile of the CLUB critic (the model compiles its own submodules), warmed up before training
+        self.compile = config['compile']
+        if self.compile:
+            self.club.forward = compile_fn(self.club.forward, 'club', mode=config['compile_mode'])
+            self.club.learning_loss = compile_fn(self.club.learning_loss, 'club', mode=config['compile_mode'])
 
         #fac = lambda epoch: 0.96 ** (epoch / 50)
         lr_scheduler = config['learning_rate_scheduler']        # check zero?
@@ -150,10 +172,15 @@ class Trainer(AbstractTrainer):
         loss_func = loss_func or self.model.calculate_loss
         total_loss = None
         loss_batches = []
+        self.club_stats = {'updates': 0, 'time': 0.0, 'mi_loss': 0.0}
+        self.train_samples = 0
         for batch_idx, interaction in enumerate(train_data):
-            self.optimizer.zero_grad()
+            # gradients of parameters unused by a step stay None, see AbstractRecommender.memory_report
+            self.optimizer.zero_grad(set_to_none=True)
+            self.train_samples += len(interaction[0])
             second_inter = interaction.clone()
-            losses, un_data = loss_func(interaction, self.club)
+            with self._autocast():
+                losses, un_data = loss_func(interaction, self.club)
             # losses = loss_func(interaction)
             
             if isinstance(losses, tuple):
@@ -172,9 +199,10 @@ class Trainer(AbstractTrainer):
                 first_loss.backward()
 
                 self.optimizer.step()
-                self.optimizer.zero_grad()
+                self.optimizer.zero_grad(set_to_none=True)
                 
-                losses = loss_func(second_inter)
+                with self._autocast():
+                    losses = loss_func(second_inter)
                 if isinstance(losses, tuple):
                     loss = sum(losses)
                 else:
@@ -189,19 +217,8 @@ class Trainer(AbstractTrainer):
                 loss.backward()
 
             # club step
-            e_zu, e_zi, e_zu1, e_zi1 = un_data
-            x_samples = e_zu.detach()
-            y_samples = e_zi.detach()
-            x_samples1 = e_zu1.detach()
-            y_samples1 = e_zi1.detach()
-            for _ in range(50):
-                random_idx = torch.randperm(x_samples.shape[0])
-                mi_loss = self.club.learning_loss(x_samples[random_idx], y_samples[random_idx])
-                mi_loss1 = self.club.learning_loss(x_samples1[random_idx], y_samples1[random_idx])
-                mi_loss = mi_loss+mi_loss1
-                self.optimizer_D.zero_grad()
-                mi_loss.backward()
-                self.optimizer_D.step()
+            if self.club_steps and batch_idx % self.club_interval == 0:
+                self._club_step(un_data)
 
             if self.clip_grad_norm:
                 clip_grad_norm_(self.model.parameters(), **self.clip_grad_norm)
@@ -212,6 +229,74 @@ class Trainer(AbstractTrainer):
             #    break
         return total_loss, loss_batches
 
+    def _club_step(self, un_data):
+        r"""Update the CLUB critic on the (detached) trans embeddings of one batch.
+
+        Args:
+            un_data (tuple): ``(t_trans1, v_trans1, t_trans2, v_trans2)`` returned by the model
+        """
+        start = time()
+        e_zu, e_zi, e_zu1, e_zi1 = un_data
+        x_samples = e_zu.detach().float()
+        y_samples = e_zi.detach().float()
+        x_samples1 = e_zu1.detach().float()
+        y_samples1 = e_zi1.detach().float()
+        n_items = x_samples.shape[0]
+        size = min(self.club_batch_size or n_items, n_items)
+        if self.club_fused:
+            idx_list = [torch.cat([torch.randperm(n_items, device=x_samples.device)[:size]
+                                   for _ in range(self.club_steps)])]
+        else:
+            idx_list = [torch.randperm(n_items, device=x_samples.device)[:size] for _ in range(self.club_steps)]
+        for random_idx in idx_list:
+            mi_loss = self.club.learning_loss(x_samples[random_idx], y_samples[random_idx])
+            mi_loss1 = self.club.learning_loss(x_samples1[random_idx], y_samples1[random_idx])
+            mi_loss = mi_loss+mi_loss1
+            self.optimizer_D.zero_grad()
+            mi_loss.backward()
+            self.optimizer_D.step()
+        self.club_stats['updates'] += len(idx_list)
+        self.club_stats['time'] += time() - start
+        self.club_stats['mi_loss'] = mi_loss.item()
+
+    def _warm_up(self, train_data):
+        r"""Run forward and backward on random batches of the full and of the last batch size, so that
+        compilation is not charged to the first epoch. No optimizer steps, model and critic states are restored.
+
+        Args:
+            train_data (TrainDataLoader): gives the batch sizes
+        """
+        start = time()
+        states = [copy.deepcopy(m.state_dict()) for m in (self.model, self.club)]
+        self.model.train()
+        batch_sizes = {train_data.step, train_data.pr_end % train_data.step} - {0}
+        # compiled functions failing here fall back to eager, later errors propagate
+        with compile_warm_up():
+            for batch_size in batch_sizes:
+                n_negs = self.config['training_neg_sample_num'] or 1
+                interaction = torch.cat((torch.randint(0, self.model.n_users, (1, batch_size)),
+                                         torch.randint(0, self.model.n_items, (1 + n_negs, batch_size)))).to(self.device)
+                with self._autocast():
+                    losses, un_data = self.model.calculate_loss(interaction, self.club)
+                loss = sum(losses) if isinstance(losses, tuple) else losses
+                loss.backward()
+                self.club.learning_loss(un_data[0].detach().float(), un_data[1].detach().float()).backward()
+        self.optimizer.zero_grad(set_to_none=True)
+        self.optimizer_D.zero_grad()
+        for m, state in zip((self.model, self.club), states):
+            m.load_state_dict(state)
+        self.logger.info('warm-up of compiled modules: %.2fs' % (time() - start))
+
+    def _autocast(self):
+        return torch.autocast(device_type=self.amp_device, dtype=torch.bfloat16,
+                              enabled=self.mixed_precision == 'bf16')
+
+    def _generate_club_output(self):
+        wandb.log({'club_time': self.club_stats['time'], 'club_mi_loss': self.club_stats['mi_loss']})
+        return 'club [steps: %d, interval: %d, batch: %s, fused: %s] updates: %d, time: %.2fs, mi loss: %.4f' % (
+            self.club_steps, self.club_interval, self.club_batch_size or 'all', bool(self.club_fused),
+            self.club_stats['updates'], self.club_stats['time'], self.club_stats['mi_loss'])
+
     def _valid_epoch(self, valid_data):
         r"""Valid the model with valid data
 
@@ -232,8 +317,10 @@ class Trainer(AbstractTrainer):
             return True
 
     def _generate_train_loss_output(self, epoch_idx, s_time, e_time, losses):
-        wandb.log({'epoch':epoch_idx, 'loss':losses})
-        train_loss_output = 'epoch %d training [time: %.2fs, ' % (epoch_idx, e_time - s_time)
+        throughput = self.train_samples / max(e_time - s_time, 1e-9)
+        wandb.log({'epoch':epoch_idx, 'loss':losses, 'throughput':throughput})
+        train_loss_output = 'epoch %d training [time: %.2fs, %s: %.0f samples/s, ' % (
+            epoch_idx, e_time - s_time, self.mixed_precision or 'fp32', throughput)
         if isinstance(losses, tuple):
             train_loss_output = ', '.join('train_loss%d: %.4f' % (idx + 1, loss) for idx, loss in enumerate(losses))
         else:
@@ -254,6 +341,8 @@ class Trainer(AbstractTrainer):
         Returns:
              (float, dict): best valid score and best valid result. If valid_data is None, it returns (-1, None)
         """
+        if self.compile:
+            self._warm_up(train_data)
         for epoch_idx in range(self.start_epoch, self.epochs):
             # train
             training_start_time = time()
@@ -273,8 +362,12 @@ class Trainer(AbstractTrainer):
             post_info = self.model.post_epoch_processing()
             if verbose:
                 self.logger.info(train_loss_output)
+                if self.club_stats is not None:
+                    self.logger.info(self._generate_club_output())
                 if post_info is not None:
                     self.logger.info(post_info)
+                if self.memory_report and epoch_idx == self.start_epoch:
+                    self.logger.info('memory report:\n' + self.model.memory_report(self.optimizer))
 
             # eval: To ensure the test result is the best model under validation data, set self.eval_step == 1
             if (epoch_idx + 1) % self.eval_step == 0:
@@ -1,8 +1,10 @@
 # coding: utf-8
 #
-# user-graph need to be generated by the following script
-# tools/generate-u-u-matrix.py
+# user-graph is generated from the training interactions by utils.user_graph.prepare_user_graph,
+# which quick_start runs before building the model
 import os
+from time import time
+from logging import getLogger
 import numpy as np
 import scipy.sparse as sp
 import torch
@@ -13,8 +15,18 @@ from torch_geometric.utils import remove_self_loops, add_self_loops, degree
 import torch_geometric
 
 from common.abstract_recommender import GeneralRecommender
-from common.loss import BPRLoss, EmbLoss
+from common.loss import BPRLoss, EmbLoss, BlockSolosimLoss
 from common.init import xavier_uniform_initialization
+from utils.ann import lsh_knn, knn_recall
+from utils.cache import ArtifactCache, file_digest
+from utils.quantize import QuantizedFeatures
+from utils.user_graph import UserGraph, user_graph_path
+from utils.utils import build_csr, sample_neighbors, build_norm_adj, to_csr, blockwise_knn, \
+    compile_fn
+
+# bump when the construction of mm_adj or of the user-item graph artifacts changes
+GRAPH_BUILDER_VERSION = 1
+
 
 class ProjectHead(nn.Module):
     def __init__(self, input_dim=2816, hidden_dim=2048, out_dim=128):
@@ -52,12 +64,15 @@ class CLUBSample(nn.Module):
         return mu, logvar
 
     def forward(self, x_samples, y_samples):
-        mu, logvar = self.get_mu_logvar(x_samples)
-        sample_size = x_samples.shape[0]
-        random_index = torch.randperm(sample_size).long()
-        positive = (-(mu - y_samples) ** 2 / logvar.exp() / 2. - logvar / 2.).sum(dim=1)
-        negative = (-(mu - y_samples[random_index]) ** 2 / logvar.exp() / 2. - logvar / 2.).sum(dim=1)
-        bound = (positive - negative).mean()
+        # logvar.exp() and the bound stay fp32 under mixed precision
+        with torch.autocast(device_type=x_samples.device.type, enabled=False):
+            x_samples, y_samples = x_samples.float(), y_samples.float()
+            mu, logvar = self.get_mu_logvar(x_samples)
+            sample_size = x_samples.shape[0]
+            random_index = torch.randperm(sample_size).long()
+            positive = (-(mu - y_samples) ** 2 / logvar.exp() / 2. - logvar / 2.).sum(dim=1)
+            negative = (-(mu - y_samples[random_index]) ** 2 / logvar.exp() / 2. - logvar / 2.).sum(dim=1)
+            bound = (positive - negative).mean()
         return torch.clamp(bound / 2., min=0.0)
 
     def loglikeli(self, x_samples, y_samples):
@@ -80,6 +95,14 @@ class SEA(GeneralRecommender):
         self.n_layers = config['n_mm_layers']
         self.knn_k = config['knn_k']
         self.mm_image_weight = config['mm_image_weight']
+        # MB per similarity tile when building the kNN item graph, None builds the full matrix
+        self.knn_memory_budget = config['knn_memory_budget']
+        # approximate kNN (sorted LSH) for large catalogs, ann_tables/ann_window trade build time for recall
+        self.knn_ann = config['knn_ann']
+        self.ann_tables = config['ann_tables']
+        self.ann_window = config['ann_window']
+        self.ann_bits = config['ann_bits']
+        self.ann_recall_sample = config['ann_recall_sample']
 
         self.alpha_contrast = args.alpha_contrast
         self.temp = args.temp
@@ -119,38 +142,63 @@ class SEA(GeneralRecommender):
         self.mm_adj = None
 
         self.mlp = nn.Linear(2*dim_x, 2*dim_x)
+        # streaming Solosimloss, avoids the dense n_items x n_items score matrix
+        self.block_solosim = BlockSolosimLoss(config['solosim_block_size']) if config['solosim_block_size'] else None
+        # 'full': all items, 'batch': positives and negatives of the batch, 'sample': random items
+        self.solosim_mode = config['solosim_mode'] or 'full'
+        self.solosim_sample_size = config['solosim_sample_size']
+        self.solosim_rows = None
+        self.solosim_timed = False
+        # items of the CLUB bound, same modes as solosim_mode
+        self.club_mode = config['club_mode'] or 'full'
+        self.club_sample_size = config['club_sample_size']
+        self.batch_items = None
+        # negatives per positive (rows 2 .. 2 + n_negs of a batch), scored together by
+        # neg_loss 'bpr' (mean of the BPR terms) or 'softmax' (sampled softmax over positive + negatives)
+        self.neg_loss = config['neg_loss'] or 'bpr'
+        # in-batch negatives: softmax of every user over the positives of the batch instead of sampled negatives
+        self.in_batch_negatives = config['in_batch_negatives']
+        self.logq_correction = config['logq_correction']
+        self.n_negs = 0 if self.in_batch_negatives else config['training_neg_sample_num'] or 1
 
         dataset_path = os.path.abspath(config['data_path'] + config['dataset'])
-        self.user_graph_dict = np.load(os.path.join(dataset_path, config['user_graph_dict_file']),
-                                       allow_pickle=True).item()
+        # user-user graph as CSR arrays, the pickled dict of older datasets is converted once
+        if config['user_graph_file']:
+            self.user_graph = UserGraph.load(user_graph_path(config, dataset.inter_matrix(form='csr')))
+        else:
+            self.user_graph = UserGraph.from_dict(np.load(os.path.join(dataset_path, config['user_graph_dict_file']),
+                                                          allow_pickle=True).item())
 
         mm_adj_file = os.path.join(dataset_path, 'mm_adj_{}.pt'.format(self.knn_k))
 
         if self.v_feat is not None:
-            self.image_embedding = nn.Embedding.from_pretrained(self.v_feat, freeze=False)
             self.image_trs = nn.Linear(self.v_feat.shape[1], self.feat_embed_dim)
         if self.t_feat is not None:
-            self.text_embedding = nn.Embedding.from_pretrained(self.t_feat, freeze=False)
             self.text_trs = nn.Linear(self.t_feat.shape[1], self.feat_embed_dim)
 
-        if os.path.exists(mm_adj_file):
+        # content-addressed cache for mm_adj and the user-item graph artifacts
+        self.artifact_cache = ArtifactCache(os.path.join(dataset_path, 'cache')) if config['artifact_cache'] else None
+        if self.artifact_cache is not None:
+            feat_files = [config['vision_feature_file'] if self.v_feat is not None else None,
+                          config['text_feature_file'] if self.t_feat is not None else None]
+            feat_digests = [(f, file_digest(os.path.join(dataset_path, f))) for f in feat_files if f is not None]
+            knn_builder = ('ann', self.ann_tables, self.ann_window, self.ann_bits, config['seed']) if self.knn_ann \
+                else 'exact'
+            mm_key = self.artifact_cache.key('mm_adj', GRAPH_BUILDER_VERSION, feat_digests, self.knn_k,
+                                             self.mm_image_weight, knn_builder)
+            self.mm_adj = self.artifact_cache.get_or_build(mm_key, lambda: {'mm_adj': self.build_mm_adj()})['mm_adj']
+        elif os.path.exists(mm_adj_file):
             self.mm_adj = torch.load(mm_adj_file)
         else:
-            if self.v_feat is not None:
-                indices, image_adj = self.get_knn_adj_mat(self.image_embedding.weight.detach())
-                self.mm_adj = image_adj
-            if self.t_feat is not None:
-                indices, text_adj = self.get_knn_adj_mat(self.text_embedding.weight.detach())
-                self.mm_adj = text_adj
-            if self.v_feat is not None and self.t_feat is not None:
-                self.mm_adj = self.mm_image_weight * image_adj + (1.0 - self.mm_image_weight) * text_adj
-                del text_adj
-                del image_adj
+            self.mm_adj = self.build_mm_adj()
             torch.save(self.mm_adj, mm_adj_file)
         self.mm_adj = self.mm_adj.to(self.device)
         # packing interaction in training into edge_index
         train_interactions = dataset.inter_matrix(form='coo').astype(np.float32)
         edge_index = self.pack_edge_index(train_interactions)
+        # log-probability of an item to be an in-batch negative, i.e. its share of the training interactions
+        item_count = np.maximum(np.bincount(train_interactions.col, minlength=self.n_items), 1)
+        self.item_log_q = torch.tensor(np.log(item_count / item_count.sum()), dtype=torch.float32).to(self.device)
         self.edge_index = torch.tensor(edge_index, dtype=torch.long).t().contiguous().to(self.device)
         self.edge_index = torch.cat((self.edge_index, self.edge_index[[1, 0]]), dim=1)
 
@@ -159,17 +207,13 @@ class SEA(GeneralRecommender):
             torch.tensor(np.random.randn(self.num_user, 2, 1), dtype=torch.float32, requires_grad=True)))
         self.weight_u.data = F.softmax(self.weight_u, dim=1)
 
-        self.item_index = torch.zeros([self.num_item], dtype=torch.long)
-        index = []
-        for i in range(self.num_item):
-            self.item_index[i] = i
-            index.append(i)
+        self.item_index = torch.arange(self.num_item)
         self.drop_percent = self.drop_rate
         self.single_percent = 1
         self.double_percent = 0
 
         drop_item = torch.tensor(
-            np.random.choice(self.item_index, int(self.num_item * self.drop_percent), replace=False))
+            np.random.choice(self.num_item, int(self.num_item * self.drop_percent), replace=False))
         drop_item_single = drop_item[:int(self.single_percent * len(drop_item))]
 
         self.dropv_node_idx_single = drop_item_single[:int(len(drop_item_single) * 1 / 3)]
@@ -178,53 +222,146 @@ class SEA(GeneralRecommender):
         self.dropv_node_idx = self.dropv_node_idx_single
         self.dropt_node_idx = self.dropt_node_idx_single
 
-        mask_cnt = torch.zeros(self.num_item, dtype=int).tolist()
-        for edge in edge_index:
-            mask_cnt[edge[1] - self.num_user] += 1
-        mask_dropv = []
-        mask_dropt = []
-        for idx, num in enumerate(mask_cnt):
-            temp_false = [False] * num
-            temp_true = [True] * num
-            mask_dropv.extend(temp_false) if idx in self.dropv_node_idx else mask_dropv.extend(temp_true)
-            mask_dropt.extend(temp_false) if idx in self.dropt_node_idx else mask_dropt.extend(temp_true)
-
-        edge_index = edge_index[np.lexsort(edge_index.T[1, None])]
-        edge_index_dropv = edge_index[mask_dropv]
-        edge_index_dropt = edge_index[mask_dropt]
-
-        self.edge_index_dropv = torch.tensor(edge_index_dropv).t().contiguous().to(self.device)
-        self.edge_index_dropt = torch.tensor(edge_index_dropt).t().contiguous().to(self.device)
-
-        self.edge_index_dropv = torch.cat((self.edge_index_dropv, self.edge_index_dropv[[1, 0]]), dim=1)
-        self.edge_index_dropt = torch.cat((self.edge_index_dropt, self.edge_index_dropt[[1, 0]]), dim=1)
+        # drop-edge sets (cheap, drawn per run) and the normalized adjacency, Base_gcn then propagates
+        # with one SpMM per layer; only the deterministic adjacency is cached
+        for name, tensor in self.build_drop_edges(edge_index).items():
+            setattr(self, name, tensor.to(self.device))
+        self.norm_adj = None
+        if config['precompute_adj']:
+            build_adj = lambda: {'norm_adj': to_csr(build_norm_adj(self.edge_index, self.num_user + self.num_item))}
+            if self.artifact_cache is not None:
+                adj_key = self.artifact_cache.key('norm_adj', GRAPH_BUILDER_VERSION, edge_index)
+                self.norm_adj = self.artifact_cache.get_or_build(adj_key, build_adj)['norm_adj'].to(self.device)
+            else:
+                self.norm_adj = build_adj()['norm_adj']
 
         self.MLP_user = nn.Linear(self.dim_latent * 2, self.dim_latent)
 
+        # sampled-subgraph training: towers only run on the k-hop neighborhood of each batch
+        self.subgraph_sampling = config['subgraph_sampling']
+        # eval-mode user/item embeddings of export_embeddings and the parameter versions they were built from
+        self.inference_embed = None
+        self.inference_version = None
+        if self.subgraph_sampling:
+            fanout = config['subgraph_fanout']
+            # one hop per Base_gcn propagation in GCN.forward
+            self.subgraph_fanout = list(fanout) if isinstance(fanout, (list, tuple)) else [fanout] * 2
+            num_nodes = self.num_user + self.num_item
+            self.ui_rowptr, self.ui_col, _ = build_csr(self.edge_index[1], self.edge_index[0], num_nodes)
+            self.ui_deg_inv_sqrt = degree(self.edge_index[0], num_nodes).pow(-0.5)
+            mm_adj = self.mm_adj.coalesce()
+            self.mm_rowptr, self.mm_col, perm = build_csr(mm_adj.indices()[0], mm_adj.indices()[1], self.num_item)
+            self.mm_val = mm_adj.values()[perm]
+
         if self.v_feat is not None:
             self.v_gcn = GCN(self.dataset, batch_size, num_user, num_item, dim_x, self.aggr_mode, dim_latent=64,
                              device=self.device, features=self.v_feat)
         if self.t_feat is not None:
             self.t_gcn = GCN(self.dataset, batch_size, num_user, num_item, dim_x, self.aggr_mode, dim_latent=64,
                              device=self.device, features=self.t_feat)
-
-
-        self.result_embed = nn.Parameter(
-            nn.init.xavier_normal_(torch.tensor(np.random.randn(num_user + num_item, dim_x)))).to(self.device)
-
-        self.result_embed_guide = nn.Parameter(
-            nn.init.xavier_normal_(torch.tensor(np.random.randn(num_user + num_item, dim_x)))).to(self.device)
-        self.result_embed_v = nn.Parameter(
-            nn.init.xavier_normal_(torch.tensor(np.random.randn(num_user + num_item, dim_x)))).to(self.device)
-        self.result_embed_t = nn.Parameter(
-            nn.init.xavier_normal_(torch.tensor(np.random.randn(num_user + num_item, dim_x)))).to(self.device)
+        # one propagation per layer for both modalities, see fused_gcn
+        self.fuse_gcn = config['fuse_gcn']
+        if config['compile']:
+            self.compile_submodules(config['compile_mode'])
+        # fp16 or int8 (per-row scale) storage of the frozen features once mm_adj is built, see item_linear
+        self.feat_storage = config['feat_storage'] or 'fp32'
+        if self.feat_storage != 'fp32':
+            self.compress_features(self.feat_storage, config['feat_block_size'] or 8192)
+
+
+        # float32 buffers overwritten by forward, not trained: on CUDA .to() already turned the former
+        # float64 Parameters into plain tensors, on CPU they stayed Parameters that forward could not assign
+        self.result_embed = nn.init.xavier_normal_(torch.tensor(
+            np.random.randn(num_user + num_item, dim_x), dtype=torch.float32)).to(self.device)
+
+        self.result_embed_guide = nn.init.xavier_normal_(torch.tensor(
+            np.random.randn(num_user + num_item, dim_x), dtype=torch.float32)).to(self.device)
+        self.result_embed_v = nn.init.xavier_normal_(torch.tensor(
+            np.random.randn(num_user + num_item, dim_x), dtype=torch.float32)).to(self.device)
+        self.result_embed_t = nn.init.xavier_normal_(torch.tensor(
+            np.random.randn(num_user + num_item, dim_x), dtype=torch.float32)).to(self.device)
+
+    def compile_submodules(self, mode=None):
+        r"""Compile the projection heads, the dense part of the GCN towers (:meth:`GCN.embed`) and the
+        batch scoring. Sparse propagation stays eager. Parameters and state dict keys are unchanged.
+
+        Args:
+            mode (str): ``torch.compile`` mode
+        """
+        for name, head in (('t_proj', self.t_proj), ('v_proj', self.v_proj)):
+            head.forward = compile_fn(head.forward, name, mode=mode)
+        for name in ('v_gcn', 't_gcn'):
+            if hasattr(self, name):
+                gcn = getattr(self, name)
+                gcn.embed = compile_fn(gcn.embed, name, mode=mode)
+        self.score = compile_fn(self.score, 'score', mode=mode)
+
+    def compress_features(self, dtype, block_size):
+        start, nbytes = time(), []
+        for name in ('v_feat', 't_feat'):
+            feat = getattr(self, name)
+            if feat is not None:
+                compressed = QuantizedFeatures.quantize(feat, dtype, block_size)
+                nbytes.append((feat.numel() * feat.element_size(), compressed.nbytes()))
+                setattr(self, name, compressed)
+        getLogger().info('{} feature storage: {:.1f}MB -> {:.1f}MB in {:.2f}s'.format(
+            dtype, sum(b[0] for b in nbytes) / 2 ** 20, sum(b[1] for b in nbytes) / 2 ** 20, time() - start))
+
+    def item_linear(self, linear, feat):
+        r"""``linear(feat)``, dequantizing compressed features block by block."""
+        if isinstance(feat, QuantizedFeatures):
+            return feat.linear(linear)
+        return linear(feat)
+
+    def build_mm_adj(self):
+        if self.v_feat is not None:
+            indices, image_adj = self.get_knn_adj_mat(self.v_feat)
+            mm_adj = image_adj
+        if self.t_feat is not None:
+            indices, text_adj = self.get_knn_adj_mat(self.t_feat)
+            mm_adj = text_adj
+        if self.v_feat is not None and self.t_feat is not None:
+            mm_adj = self.mm_image_weight * image_adj + (1.0 - self.mm_image_weight) * text_adj
+            del text_adj
+            del image_adj
+        return mm_adj
+
+    def build_drop_edges(self, edge_index):
+        r"""Drop-edge sets of the user-item graph (GCN.forward does not propagate over them).
+
+        Args:
+            edge_index (numpy.ndarray): packed training interactions, shape: [num_inters, 2]
+
+        Returns:
+            dict: attribute name -> tensor
+        """
+        graph = {}
+        for name, drop_items in (('dropv', self.dropv_node_idx), ('dropt', self.dropt_node_idx)):
+            edges = torch.tensor(drop_item_edges(edge_index, self.num_user, drop_items.numpy())).t().contiguous()
+            graph['edge_index_' + name] = torch.cat((edges, edges[[1, 0]]), dim=1)
+        return graph
 
     def get_knn_adj_mat(self, mm_embeddings):
-        context_norm = mm_embeddings.div(torch.norm(mm_embeddings, p=2, dim=-1, keepdim=True))
-        sim = torch.mm(context_norm, context_norm.transpose(1, 0))
-        _, knn_ind = torch.topk(sim, self.knn_k, dim=-1)
-        adj_size = sim.size()
-        del sim
+        memory_budget = (self.knn_memory_budget or 256) * 2 ** 20
+        if self.knn_ann:
+            start = time()
+            knn_ind = lsh_knn(mm_embeddings, self.knn_k, n_tables=self.ann_tables, window=self.ann_window,
+                              n_bits=self.ann_bits, memory_budget=memory_budget)
+            build_time = time() - start
+            recall = knn_recall(mm_embeddings, knn_ind, self.ann_recall_sample, memory_budget)
+            getLogger().info('ANN kNN graph: {} items, build time: {:.2f}s, recall@{} on {} sampled items: {:.4f}'.format(
+                mm_embeddings.shape[0], build_time, self.knn_k, min(self.ann_recall_sample, mm_embeddings.shape[0]),
+                recall))
+            adj_size = torch.Size((mm_embeddings.shape[0], mm_embeddings.shape[0]))
+        elif self.knn_memory_budget:
+            knn_ind = blockwise_knn(mm_embeddings, self.knn_k, memory_budget)
+            adj_size = torch.Size((mm_embeddings.shape[0], mm_embeddings.shape[0]))
+        else:
+            context_norm = mm_embeddings.div(torch.norm(mm_embeddings, p=2, dim=-1, keepdim=True))
+            sim = torch.mm(context_norm, context_norm.transpose(1, 0))
+            _, knn_ind = torch.topk(sim, self.knn_k, dim=-1)
+            adj_size = sim.size()
+            del sim
         # construct sparse adj
         indices0 = torch.arange(knn_ind.shape[0]).to(self.device)
         indices0 = torch.unsqueeze(indices0, 1)
@@ -246,6 +383,51 @@ class SEA(GeneralRecommender):
         self.epoch_user_graph, self.user_weight_matrix = self.topk_sample(self.k)
         self.user_weight_matrix = self.user_weight_matrix.to(self.device)
 
+    def post_epoch_processing(self):
+        # timed once, after the first epoch
+        if self.solosim_mode == 'full' or self.solosim_rows is None or self.solosim_timed:
+            return None
+        self.solosim_timed = True
+        return self.solosim_speedup()
+
+    def solosim_speedup(self):
+        r"""Time projection heads + Solosimloss (forward and backward) on as many rows as the last
+        training step used, against the full catalog. Without ``solosim_block_size``, the full catalog
+        reference streams the scores in tiles of ``solosim_sample_size`` rows once they do not fit in
+        one tile, instead of building the dense n_items x n_items matrix.
+
+        Returns:
+            str: timing report, logged by the trainer after the first epoch
+        """
+        with torch.no_grad():
+            t_item_embeddings = self.item_linear(self.t_item_linear, self.t_feat)
+            v_item_embeddings = self.item_linear(self.v_item_linear, self.v_feat)
+        heads = (self.t_proj, self.v_proj)
+        modes = [head.training for head in heads]
+        # keep BatchNorm running statistics untouched
+        for head in heads:
+            head.eval()
+        params = [p for head in heads for p in head.parameters()]
+        rows = torch.randperm(self.n_items, device=t_item_embeddings.device)[:self.solosim_rows]
+        full_block = None
+        if self.block_solosim is None and self.n_items > self.solosim_sample_size:
+            full_block = BlockSolosimLoss(self.solosim_sample_size)
+        timings = []
+        for t_emb, v_emb, block in ((t_item_embeddings[rows], v_item_embeddings[rows], None),
+                                    (t_item_embeddings, v_item_embeddings, full_block)):
+            start = time()
+            loss = self.Solosimloss(self.t_proj(t_emb[:, :192]), self.v_proj(v_emb[:, :2048]), temperature=self.temp,
+                                    block_loss=block)
+            torch.autograd.grad(loss, params)
+            if t_emb.is_cuda:
+                torch.cuda.synchronize()
+            timings.append(time() - start)
+        for head, mode in zip(heads, modes):
+            head.train(mode)
+        return 'Solosimloss [{}] on {}/{} items: {:.2f}ms, full catalog: {:.2f}ms, speedup: {:.1f}x'.format(
+            self.solosim_mode, self.solosim_rows, self.n_items, timings[0] * 1000, timings[1] * 1000,
+            timings[1] / max(timings[0], 1e-9))
+
     def pack_edge_index(self, inter_mat):
         rows = inter_mat.row
         cols = inter_mat.col + self.n_users
@@ -253,22 +435,107 @@ class SEA(GeneralRecommender):
         return np.column_stack((rows, cols))
 
     def forward(self, interaction):
-        user_nodes, pos_item_nodes, neg_item_nodes = interaction[0], interaction[1], interaction[2]
+        if self.training and self.subgraph_sampling:
+            return self.subgraph_forward(interaction)
+        user_nodes, pos_item_nodes, neg_item_nodes = interaction[0], interaction[1], interaction[2:2 + self.n_negs]
+        batch_items = torch.cat((pos_item_nodes, neg_item_nodes.flatten()))
         pos_item_nodes += self.n_users
         neg_item_nodes += self.n_users
 
-        t_item_embeddings = self.t_item_linear(self.t_feat)
-        v_item_embeddings = self.v_item_linear(self.v_feat)
+        t_item_embeddings = self.item_linear(self.t_item_linear, self.t_feat)
+        v_item_embeddings = self.item_linear(self.v_item_linear, self.v_feat)
 
         # Prepare for Contrastive learning
         t_dim = int(t_item_embeddings.shape[1] / 2)
         v_dim = int(v_item_embeddings.shape[1] / 2)
-        t_emd_proj = self.t_proj(t_item_embeddings[:, :192])
-        v_emd_proj = self.v_proj(v_item_embeddings[:, :2048])
+        t_emd_proj, v_emd_proj = self.project(t_item_embeddings, v_item_embeddings, batch_items)
+
+        self.result_embed = self.compute_result_embed(t_item_embeddings, v_item_embeddings)
+
+        # calculate pos and neg scores
+        user_tensor = self.result_embed[user_nodes]
+        pos_item_tensor = self.result_embed[pos_item_nodes]
+        if self.in_batch_negatives:
+            return (*self.in_batch_score(user_tensor, pos_item_tensor, pos_item_nodes - self.n_users),
+                    t_emd_proj, v_emd_proj, t_item_embeddings, v_item_embeddings, t_dim, v_dim)
+        neg_item_tensor = self.result_embed[neg_item_nodes]
+        pos_scores, neg_scores = self.score(user_tensor, pos_item_tensor, neg_item_tensor)
+        return pos_scores, neg_scores, t_emd_proj, v_emd_proj, t_item_embeddings, v_item_embeddings, t_dim, v_dim
 
+    def project(self, t_item_embeddings, v_item_embeddings, batch_items):
+        r"""Run the projection heads of Solosimloss on the rows selected by ``solosim_mode``.
+
+        Args:
+            batch_items (torch.Tensor): rows of the item embeddings that are positives/negatives of the batch
+        """
+        self.batch_items = batch_items
+        rows = self.select_rows(self.solosim_mode, self.solosim_sample_size, t_item_embeddings.shape[0], batch_items)
+        if rows is not None:
+            t_item_embeddings, v_item_embeddings = t_item_embeddings[rows], v_item_embeddings[rows]
+        self.solosim_rows = t_item_embeddings.shape[0]
+        return self.t_proj(t_item_embeddings[:, :192]), self.v_proj(v_item_embeddings[:, :2048])
+
+    def select_rows(self, mode, sample_size, n_rows, batch_items):
+        r"""Rows of the item embeddings a loss term is estimated on.
+
+        Args:
+            mode (str): 'full', 'batch' (positives and negatives of the batch, at most ``sample_size``)
+                or 'sample' (``sample_size`` random items)
+            sample_size (int): number of rows for 'batch' and 'sample'
+            n_rows (int): rows of the item embeddings
+            batch_items (torch.Tensor): rows of the positives/negatives of the batch
+
+        Returns:
+            torch.Tensor: selected rows, ``None`` for all rows
+        """
+        if mode == 'batch':
+            rows = torch.unique(batch_items)
+            if sample_size and rows.shape[0] > sample_size:
+                rows = rows[torch.randperm(rows.shape[0], device=rows.device)[:sample_size]]
+            return rows
+        if mode == 'sample':
+            return torch.randperm(n_rows, device=batch_items.device)[:sample_size]
+        return None
+
+    def score(self, user_tensor, pos_item_tensor, neg_item_tensor):
+        r"""Scores of the positives, shape: [batch], and of the negatives, shape: [n_negs, batch]
+        (``neg_item_tensor``: [n_negs, batch, dim], broadcast against the users)."""
+        pos_scores = torch.sum(user_tensor * pos_item_tensor, dim=1)
+        neg_scores = torch.sum(user_tensor * neg_item_tensor, dim=-1)
+        return pos_scores, neg_scores
+
+    def in_batch_score(self, user_tensor, pos_item_tensor, pos_items):
+        r"""Score every user of the batch against every positive item of the batch with one matmul.
+
+        Other occurrences of a user's own positive item are masked out. With ``logq_correction`` the
+        log-probability of each item to appear in a batch is subtracted, so popular items are not
+        over-penalized as negatives.
+
+        Args:
+            pos_items (torch.Tensor): positive item ids, shape: [batch]
+
+        Returns:
+            tuple:
+            - torch.Tensor, scores of the positives (diagonal), shape: [batch]
+            - torch.Tensor, scores of every user against every positive, shape: [batch, batch]
+        """
+        logits = user_tensor @ pos_item_tensor.t()
+        if self.logq_correction:
+            logits = logits - self.item_log_q[pos_items].to(logits.dtype)
+        hit = pos_items.unsqueeze(1) == pos_items.unsqueeze(0)
+        hit.fill_diagonal_(False)
+        logits = logits.masked_fill(hit, float('-inf'))
+        return torch.diagonal(logits), logits
+
+    def compute_result_embed(self, t_item_embeddings, v_item_embeddings):
         # GCN for id, v, t modalities
-        self.v_rep, _ = self.v_gcn(self.edge_index_dropv, self.edge_index, v_item_embeddings)  # 7050, 4096 -> 26495, 64
-        self.t_rep, _ = self.t_gcn(self.edge_index_dropt, self.edge_index, t_item_embeddings)  # 7050, 384 -> 26495, 64
+        graph = self.norm_adj if self.norm_adj is not None else self.edge_index
+        graph_dropv, graph_dropt = self.edge_index_dropv, self.edge_index_dropt
+        if self.fuse_gcn:
+            self.v_rep, self.t_rep = fused_gcn((self.v_gcn, self.t_gcn), (v_item_embeddings, t_item_embeddings), graph)
+        else:
+            self.v_rep, _ = self.v_gcn(graph_dropv, graph, v_item_embeddings)  # 7050, 4096 -> 26495, 64
+            self.t_rep, _ = self.t_gcn(graph_dropt, graph, t_item_embeddings)  # 7050, 384 -> 26495, 64
 
         # v, v, id, and vt modalities
         representation = torch.cat((self.v_rep, self.t_rep), dim=1) # -> 26495, 128
@@ -291,28 +558,129 @@ class SEA(GeneralRecommender):
         # build result embedding
         self.user_rep = user_rep
         self.item_rep = item_rep
-        self.result_embed = torch.cat((user_rep, item_rep), dim=0)
+        return torch.cat((user_rep, item_rep), dim=0)
 
-        # calculate pos and neg scores
-        user_tensor = self.result_embed[user_nodes]
-        pos_item_tensor = self.result_embed[pos_item_nodes]
-        neg_item_tensor = self.result_embed[neg_item_nodes]
-        pos_scores = torch.sum(user_tensor * pos_item_tensor, dim=1)
-        neg_scores = torch.sum(user_tensor * neg_item_tensor, dim=1)
+    def subgraph_forward(self, interaction):
+        r"""Same as :meth:`forward`, but the towers only run on the sampled neighborhood of the batch.
+
+        Scores of the batch are exact when ``subgraph_fanout`` is ``None``; the contrastive and CLUB
+        terms are computed over the items of the subgraph instead of the whole catalog.
+        """
+        user_nodes, pos_item_nodes, neg_item_nodes = interaction[0], interaction[1], interaction[2:2 + self.n_negs]
+        nodes, n_sub_users, edge_index, edge_weight, item_adj = self.sample_subgraph(
+            user_nodes, torch.cat((pos_item_nodes, neg_item_nodes.flatten())))
+        pos_item_nodes += self.n_users
+        neg_item_nodes += self.n_users
+        item_nodes = nodes[n_sub_users:] - self.n_users
+
+        t_item_embeddings = self.item_linear(self.t_item_linear, self.t_feat[item_nodes])
+        v_item_embeddings = self.item_linear(self.v_item_linear, self.v_feat[item_nodes])
+
+        t_dim = int(t_item_embeddings.shape[1] / 2)
+        v_dim = int(v_item_embeddings.shape[1] / 2)
+        batch_items = torch.searchsorted(
+            item_nodes, torch.cat((pos_item_nodes, neg_item_nodes.flatten())) - self.n_users)
+        t_emd_proj, v_emd_proj = self.project(t_item_embeddings, v_item_embeddings, batch_items)
+
+        if self.fuse_gcn:
+            v_rep, t_rep = fused_gcn((self.v_gcn, self.t_gcn), (v_item_embeddings, t_item_embeddings),
+                                     edge_index, nodes=nodes, edge_weight=edge_weight)
+        else:
+            v_rep, _ = self.v_gcn(edge_index, edge_index, v_item_embeddings, nodes=nodes, edge_weight=edge_weight)
+            t_rep, _ = self.t_gcn(edge_index, edge_index, t_item_embeddings, nodes=nodes, edge_weight=edge_weight)
+        representation = torch.cat((v_rep, t_rep), dim=1)
+
+        user_rep = torch.cat((v_rep[:n_sub_users].unsqueeze(2), t_rep[:n_sub_users].unsqueeze(2)), dim=2)
+        user_rep = self.weight_u[nodes[:n_sub_users]].transpose(1, 2) * user_rep
+        user_rep = torch.cat((user_rep[:, :, 0], user_rep[:, :, 1]), dim=1)
+
+        item_rep = representation[n_sub_users:]
+        h = item_rep
+        for i in range(self.n_layers):
+            h = sparse_mm(item_adj, h)
+        item_rep = item_rep + h
+
+        sub_embed = torch.cat((user_rep, item_rep), dim=0)
+        user_tensor = sub_embed[torch.searchsorted(nodes, user_nodes)]
+        pos_item_tensor = sub_embed[torch.searchsorted(nodes, pos_item_nodes)]
+        if self.in_batch_negatives:
+            return (*self.in_batch_score(user_tensor, pos_item_tensor, pos_item_nodes - self.n_users),
+                    t_emd_proj, v_emd_proj, t_item_embeddings, v_item_embeddings, t_dim, v_dim)
+        neg_item_tensor = sub_embed[torch.searchsorted(nodes, neg_item_nodes)]
+        pos_scores, neg_scores = self.score(user_tensor, pos_item_tensor, neg_item_tensor)
         return pos_scores, neg_scores, t_emd_proj, v_emd_proj, t_item_embeddings, v_item_embeddings, t_dim, v_dim
 
+    def sample_subgraph(self, user_nodes, item_nodes):
+        r"""Collect the nodes and edges needed to score ``user_nodes`` and ``item_nodes``.
+
+        Items are first expanded over ``n_layers`` hops of ``mm_adj`` (buildItemGraph), then all
+        targets are expanded over the two user-item propagations of :class:`GCN`.
+
+        Returns:
+            tuple: sorted global node ids (users first), number of users among them, local edge_index
+            and edge weights of the user-item subgraph, and the local item-item adjacency.
+        """
+        items = torch.unique(item_nodes)
+        mm_eid, mm_dst = [], []
+        frontier = items
+        for i in range(self.n_layers):
+            eid, dst, _ = sample_neighbors(self.mm_rowptr, self.mm_col, frontier)
+            mm_eid.append(eid)
+            mm_dst.append(dst)
+            src = torch.unique(self.mm_col[eid])
+            frontier = src[~torch.isin(src, items)]
+            items = torch.cat((items, frontier))
+
+        nodes = torch.unique(torch.cat((user_nodes, items + self.n_users)))
+        ui_eid, ui_dst, ui_scale = [], [], []
+        frontier = nodes
+        for fanout in self.subgraph_fanout:
+            eid, dst, scale = sample_neighbors(self.ui_rowptr, self.ui_col, frontier, fanout)
+            ui_eid.append(eid)
+            ui_dst.append(dst)
+            ui_scale.append(scale)
+            src = torch.unique(self.ui_col[eid])
+            frontier = src[~torch.isin(src, nodes)]
+            nodes = torch.cat((nodes, frontier))
+        nodes, _ = torch.sort(nodes)
+        n_sub_users = int((nodes < self.n_users).sum())
+
+        # normalize with the full-graph degree so that target rows match the full propagation
+        src, dst = self.ui_col[torch.cat(ui_eid)], torch.cat(ui_dst)
+        edge_weight = self.ui_deg_inv_sqrt[src] * self.ui_deg_inv_sqrt[dst] * torch.cat(ui_scale)
+        edge_index = torch.stack((torch.searchsorted(nodes, src), torch.searchsorted(nodes, dst)))
+
+        sub_items = nodes[n_sub_users:] - self.n_users
+        eid = torch.cat(mm_eid)
+        item_index = torch.stack((torch.searchsorted(sub_items, torch.cat(mm_dst)),
+                                  torch.searchsorted(sub_items, self.mm_col[eid])))
+        item_adj = torch.sparse_coo_tensor(item_index, self.mm_val[eid], (sub_items.shape[0], sub_items.shape[0]))
+        return nodes, n_sub_users, edge_index, edge_weight, item_adj
+
     def buildItemGraph(self, h):
         for i in range(self.n_layers):
-            h = torch.sparse.mm(self.mm_adj, h)
+            h = sparse_mm(self.mm_adj, h)
         return h
 
     def calculate_loss(self, interaction, club):
         user = interaction[0]
         pos_scores, neg_scores, t_emd_proj, v_emd_proj, t_item_embeddings, v_item_embeddings, t_dim, v_dim = self.forward(interaction)
-        loss_value = -torch.mean(torch.log2(torch.sigmoid(pos_scores - neg_scores)))
+        if self.in_batch_negatives:
+            # neg_scores: [batch, batch] scores of every user against the positives of the batch
+            labels = torch.arange(neg_scores.shape[0], device=neg_scores.device)
+            loss_value = F.cross_entropy(neg_scores.float(), labels)
+        elif self.neg_loss == 'softmax':
+            logits = torch.cat((pos_scores.unsqueeze(0), neg_scores), dim=0).float()
+            loss_value = -torch.mean(F.log_softmax(logits, dim=0)[0])
+        else:
+            loss_value = -torch.mean(torch.log2(torch.sigmoid(pos_scores - neg_scores)))
 
         loss_Solosimloss = self.Solosimloss(t_emd_proj, v_emd_proj, temperature=self.temp)
 
+        # CLUB bound on a subset of the items, the trans layers only run on those rows
+        rows = self.select_rows(self.club_mode, self.club_sample_size, t_item_embeddings.shape[0], self.batch_items)
+        if rows is not None:
+            t_item_embeddings, v_item_embeddings = t_item_embeddings[rows], v_item_embeddings[rows]
         t_trans1 = self.t_trans1(t_item_embeddings[:, :192])
         v_trans1 = self.v_trans1(v_item_embeddings[:, :2048])
         t_trans2 = self.t_trans2(t_item_embeddings[:, 192:])
@@ -329,57 +697,57 @@ class SEA(GeneralRecommender):
         loss = loss_value + (loss_e1 + loss_e2)/2 + self.alpha_contrast * loss_Solosimloss
         return loss, (t_trans1, v_trans1, t_trans2, v_trans2)
 
+    def parameter_version(self):
+        # in-place updates (optimizer steps, load_state_dict) bump the version counter of a tensor
+        return tuple(p._version for p in self.parameters())
+
+    @torch.no_grad()
+    def export_embeddings(self):
+        r"""User and item embeddings of the full towers, computed once in eval mode on the full graph
+        and cached until the parameters change.
+
+        Returns:
+            tuple:
+            - torch.Tensor, user embeddings, shape: [n_users, 2 * embedding_size]
+            - torch.Tensor, item embeddings, shape: [n_items, 2 * embedding_size]
+        """
+        version = self.parameter_version()
+        if self.inference_embed is None or self.inference_version != version:
+            training = self.training
+            self.eval()
+            embed = self.compute_result_embed(self.item_linear(self.t_item_linear, self.t_feat),
+                                              self.item_linear(self.v_item_linear, self.v_feat))
+            self.train(training)
+            self.inference_embed = (embed[:self.n_users], embed[self.n_users:])
+            self.inference_version = version
+        return self.inference_embed
+
     def full_sort_predict(self, interaction):
-        user_tensor = self.result_embed[:self.n_users]
-        item_tensor = self.result_embed[self.n_users:]
+        user_tensor, item_tensor = self.export_embeddings()
 
         temp_user_tensor = user_tensor[interaction[0], :]
         score_matrix = torch.matmul(temp_user_tensor, item_tensor.t())
         return score_matrix
 
     def topk_sample(self, k):
-        user_graph_index = []
-        count_num = 0
-        user_weight_matrix = torch.zeros(len(self.user_graph_dict), k)
-        tasike = []
-        for i in range(k):
-            tasike.append(0)
-        for i in range(len(self.user_graph_dict)):
-            if len(self.user_graph_dict[i][0]) < k:
-                count_num += 1
-                if len(self.user_graph_dict[i][0]) == 0:
-                    # pdb.set_trace()
-                    user_graph_index.append(tasike)
-                    continue
-                user_graph_sample = self.user_graph_dict[i][0][:k]
-                user_graph_weight = self.user_graph_dict[i][1][:k]
-                while len(user_graph_sample) < k:
-                    rand_index = np.random.randint(0, len(user_graph_sample))
-                    user_graph_sample.append(user_graph_sample[rand_index])
-                    user_graph_weight.append(user_graph_weight[rand_index])
-                user_graph_index.append(user_graph_sample)
-
-                user_weight_matrix[i] = F.softmax(torch.tensor(user_graph_weight), dim=0)  # softmax
-                continue
-            user_graph_sample = self.user_graph_dict[i][0][:k]
-            user_graph_weight = self.user_graph_dict[i][1][:k]
-
-            user_weight_matrix[i] = F.softmax(torch.tensor(user_graph_weight), dim=0)  # softmax
-            user_graph_index.append(user_graph_sample)
-
-        # pdb.set_trace()
-        return user_graph_index, user_weight_matrix
+        return self.user_graph.topk_sample(k)
 
     def print_embd(self):
         return self.result_embed_v, self.result_embed_t
     
     # corresponds to Eq.16
-    def Solosimloss(self, view1, view2, temperature: float, b_cos: bool = True):
-        if b_cos:
-            view1, view2 = F.normalize(view1, dim=1), F.normalize(view2, dim=1)
-
-        pos_score = (view1 @ view2.T) / temperature
-        score = torch.diag(F.log_softmax(pos_score, dim=1))
+    def Solosimloss(self, view1, view2, temperature: float, b_cos: bool = True, block_loss=None):
+        # scores and log_softmax stay fp32 under mixed precision
+        with torch.autocast(device_type=view1.device.type, enabled=False):
+            view1, view2 = view1.float(), view2.float()
+            if b_cos:
+                view1, view2 = F.normalize(view1, dim=1), F.normalize(view2, dim=1)
+
+            block_loss = block_loss or self.block_solosim
+            if block_loss is not None:
+                return block_loss(view1, view2, temperature)
+            pos_score = (view1 @ view2.T) / temperature
+            score = torch.diag(F.log_softmax(pos_score, dim=1))
         return -score.mean()
 
 
@@ -411,16 +779,21 @@ class GCN(torch.nn.Module):
                 gain=1).to(self.device))
             self.conv_embed_1 = Base_gcn(self.dim_latent, self.dim_latent, aggr=self.aggr_mode)
 
-    def forward(self, edge_index_drop, edge_index, features, perturbed=False):
+    def embed(self, features, nodes=None):
+        # nodes: sorted global ids of a sampled subgraph, features then only hold its item rows
         temp_features = self.MLP_1(F.leaky_relu(self.MLP(features))) if self.dim_latent else features
-        x = torch.cat((self.preference, temp_features), dim=0).to(self.device)
-        x = F.normalize(x).to(self.device)
+        preference = self.preference if nodes is None else self.preference[nodes[nodes < self.num_user]]
+        x = torch.cat((preference, temp_features), dim=0).to(self.device)
+        return F.normalize(x).to(self.device)
 
-        h = self.conv_embed_1(x, edge_index)
+    def forward(self, edge_index_drop, edge_index, features, perturbed=False, nodes=None, edge_weight=None):
+        x = self.embed(features, nodes)
+
+        h = self.conv_embed_1(x, edge_index, edge_weight=edge_weight)
         if perturbed:
             random_noise = torch.rand_like(h).to(self.device)
             h += torch.sign(h) * F.normalize(random_noise, dim=-1) * 0.1
-        h_1 = self.conv_embed_1(h, edge_index)
+        h_1 = self.conv_embed_1(h, edge_index, edge_weight=edge_weight)
         if perturbed:
             random_noise = torch.rand_like(h).to(self.device)
             h_1 += torch.sign(h_1) * F.normalize(random_noise, dim=-1) * 0.1
@@ -430,6 +803,52 @@ class GCN(torch.nn.Module):
         return x_hat, self.preference
 
 
+def drop_item_edges(edge_index, num_user, drop_items):
+    r"""Remove every interaction of ``drop_items`` from packed ``(user, item + num_user)`` edges.
+
+    Args:
+        edge_index (numpy.ndarray): edges from ``SEA.pack_edge_index``, shape: [num_edges, 2]
+        num_user (int): offset of item ids in ``edge_index``
+        drop_items (numpy.ndarray): item ids to drop
+
+    Returns:
+        numpy.ndarray: remaining edges, stably sorted by item, shape: [num_kept_edges, 2]
+    """
+    edge_index = edge_index[np.argsort(edge_index[:, 1], kind='stable')]
+    return edge_index[~np.isin(edge_index[:, 1] - num_user, drop_items)]
+
+
+def sparse_mm(adj, x):
+    r"""``torch.sparse.mm(adj, x)`` in fp32, also under bf16 autocast: CSR products have no bf16 kernel on
+    CPU and a bf16 COO product breaks the backward pass against the fp32 adjacency."""
+    with torch.autocast(device_type=x.device.type, enabled=False):
+        return torch.sparse.mm(adj, x.float())
+
+
+def fused_gcn(gcns, features, edge_index, nodes=None, edge_weight=None):
+    r"""Run several modality :class:`GCN` towers with one sparse propagation per layer.
+
+    The latent channels of all modalities are stacked side by side, so the user-item propagation
+    (which is channel-wise) gathers and scatters once for every modality instead of once per modality.
+
+    Args:
+        gcns (list of GCN): one tower per modality
+        features (list of torch.Tensor): item features of each modality, in the same order
+        edge_index (torch.Tensor): user-item edges shared by all modalities
+
+    Returns:
+        tuple of torch.Tensor: x_hat of each modality, same as ``GCN.forward``
+    """
+    xs = [gcn.embed(feat, nodes) for gcn, feat in zip(gcns, features)]
+    x = torch.cat(xs, dim=1)
+    # Base_gcn has no weights, any tower's conv can propagate the stacked channels
+    conv = gcns[0].conv_embed_1
+    h = conv(x, edge_index, edge_weight=edge_weight)
+    h_1 = conv(h, edge_index, edge_weight=edge_weight)
+    x_hat = x + h + h_1
+    return torch.split(x_hat, [_.shape[1] for _ in xs], dim=1)
+
+
 class Base_gcn(MessagePassing):
     def __init__(self, in_channels, out_channels, normalize=True, bias=True, aggr='add', **kwargs):
         super(Base_gcn, self).__init__(aggr=aggr, **kwargs)
@@ -437,18 +856,24 @@ class Base_gcn(MessagePassing):
         self.in_channels = in_channels
         self.out_channels = out_channels
 
-    def forward(self, x, edge_index, size=None):
+    def forward(self, x, edge_index, size=None, edge_weight=None):
+        x = x.unsqueeze(-1) if x.dim() == 1 else x
+        if edge_index.layout != torch.strided:
+            # normalized adjacency from build_norm_adj
+            return sparse_mm(edge_index, x)
         # pdb.set_trace()
         if size is None:
-            edge_index, _ = remove_self_loops(edge_index)
+            edge_index, edge_weight = remove_self_loops(edge_index, edge_weight)
             # edge_index, _ = add_self_loops(edge_index, num_nodes=x.size(0))
-        x = x.unsqueeze(-1) if x.dim() == 1 else x
         # pdb.set_trace()
-        return self.propagate(edge_index, size=(x.size(0), x.size(0)), x=x)
+        return self.propagate(edge_index, size=(x.size(0), x.size(0)), x=x, edge_weight=edge_weight)
 
-    def message(self, x_j, edge_index, size):
+    def message(self, x_j, edge_index, size, edge_weight):
         if self.aggr == 'add':
             # pdb.set_trace()
+            if edge_weight is not None:
+                # precomputed normalization, e.g. from a sampled subgraph
+                return edge_weight.view(-1, 1) * x_j
             row, col = edge_index
             deg = degree(row, size[0], dtype=x_j.dtype)
             deg_inv_sqrt = deg.pow(-0.5)
@@ -0,0 +1,102 @@
+# coding: utf-8
+"""
+Benchmark the steady-state training step of the SEA towers with and without torch.compile:
+projection heads, GCN towers (fused propagation), batch scoring and CLUB bound on random data.
+The first --warmup steps (compilation) are timed separately from the measured steps.
+Needs torch >= 2.0; with the pinned torch 1.11 both runs are eager.
+
+    python tools/bench_compile.py --users 20000 --items 7000 --inters 160000 --compile_mode max-autotune
+"""
+import os
+import sys
+import argparse
+from time import time
+
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.SEA import SEA, ProjectHead, CLUBSample, GCN, fused_gcn
+from utils.utils import build_norm_adj, to_csr, compile_fn, compile_warm_up
+from tools.bench_gcn import random_edge_index
+
+
+def build(args, v_feat, t_feat, compile_mode=None, compiled=False):
+    torch.manual_seed(0)
+    v_linear, t_linear = nn.Linear(v_feat.shape[1], 4096), nn.Linear(t_feat.shape[1], 384)
+    # the towers read the outputs of the linear layers, GCN only takes its input width from features
+    m = nn.ModuleDict({
+        'v_linear': v_linear, 't_linear': t_linear,
+        'v_proj': ProjectHead(input_dim=2048, hidden_dim=args.hidden_dim, out_dim=args.out_dim),
+        't_proj': ProjectHead(input_dim=192, hidden_dim=args.hidden_dim, out_dim=args.out_dim),
+        'v_gcn': GCN(None, args.batch_size, args.users, args.items, 64, 'add', dim_latent=64, device='cpu',
+                     features=torch.empty(0, v_linear.out_features)),
+        't_gcn': GCN(None, args.batch_size, args.users, args.items, 64, 'add', dim_latent=64, device='cpu',
+                     features=torch.empty(0, t_linear.out_features)),
+        'club': CLUBSample(x_dim=32, y_dim=32, hidden_size=16)})
+    score = lambda u, p, n: SEA.score(None, u, p, n)
+    if compiled:
+        for name in ('v_proj', 't_proj', 'club'):
+            m[name].forward = compile_fn(m[name].forward, name, mode=compile_mode)
+        for name in ('v_gcn', 't_gcn'):
+            m[name].embed = compile_fn(m[name].embed, name, mode=compile_mode)
+        score = compile_fn(score, 'score', mode=compile_mode)
+    return m, score
+
+
+def train_step(m, score, optimizer, v_feat, t_feat, adj, args):
+    optimizer.zero_grad()
+    users = torch.randint(0, args.users, (args.batch_size,))
+    pos = torch.randint(0, args.items, (args.batch_size,)) + args.users
+    neg = torch.randint(0, args.items, (args.batch_size,)) + args.users
+    v_emb, t_emb = m['v_linear'](v_feat), m['t_linear'](t_feat)
+    v_proj, t_proj = m['v_proj'](v_emb[:, :2048]), m['t_proj'](t_emb[:, :192])
+    v_rep, t_rep = fused_gcn((m['v_gcn'], m['t_gcn']), (v_emb, t_emb), adj)
+    rep = torch.cat((v_rep, t_rep), dim=1)
+    pos_scores, neg_scores = score(rep[users], rep[pos], rep[neg])
+    loss = -torch.mean(torch.log2(torch.sigmoid(pos_scores - neg_scores)))
+    loss = loss - (v_proj * t_proj).sum(dim=1).mean() + m['club'](v_proj[:, :32], t_proj[:, :32])
+    loss.backward()
+    optimizer.step()
+
+
+def run(args, v_feat, t_feat, adj, compiled):
+    m, score = build(args, v_feat, t_feat, args.compile_mode, compiled)
+    optimizer = torch.optim.Adam(m.parameters(), lr=1e-4)
+    start = time()
+    with compile_warm_up():
+        for _ in range(args.warmup):
+            train_step(m, score, optimizer, v_feat, t_feat, adj, args)
+    warmup_time = time() - start
+    start = time()
+    for _ in range(args.steps):
+        train_step(m, score, optimizer, v_feat, t_feat, adj, args)
+    return warmup_time, (time() - start) / args.steps
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--items', type=int, default=7000)
+    parser.add_argument('--inters', type=int, default=160000)
+    parser.add_argument('--v_dim', type=int, default=4096)
+    parser.add_argument('--t_dim', type=int, default=384)
+    parser.add_argument('--hidden_dim', type=int, default=512)
+    parser.add_argument('--out_dim', type=int, default=128)
+    parser.add_argument('--batch_size', type=int, default=2048)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--compile_mode', type=str, default=None)
+    args, _ = parser.parse_known_args()
+
+    v_feat, t_feat = torch.randn(args.items, args.v_dim), torch.randn(args.items, args.t_dim)
+    num_nodes = args.users + args.items
+    adj = to_csr(build_norm_adj(random_edge_index(args.users, args.items, args.inters), num_nodes))
+
+    eager_warmup, eager_step = run(args, v_feat, t_feat, adj, compiled=False)
+    compiled_warmup, compiled_step = run(args, v_feat, t_feat, adj, compiled=True)
+    print('nodes: {}, items: {}, batch: {}, compile mode: {}'.format(
+        num_nodes, args.items, args.batch_size, args.compile_mode))
+    print('eager:    warm-up {:.2f}s, {:.2f}ms/step'.format(eager_warmup, eager_step * 1000))
+    print('compiled: warm-up {:.2f}s, {:.2f}ms/step ({:.2f}x)'.format(
+        compiled_warmup, compiled_step * 1000, eager_step / compiled_step))
@@ -0,0 +1,60 @@
+# coding: utf-8
+"""
+Benchmark Base_gcn propagation on CPU: PyG message passing over edge_index
+against one SpMM with the normalized adjacency built once by build_norm_adj.
+
+    python tools/bench_gcn.py --users 20000 --items 7000 --inters 160000
+"""
+import os
+import sys
+import argparse
+from time import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.SEA import Base_gcn
+from utils.utils import build_norm_adj, to_csr
+
+
+def random_edge_index(n_users, n_items, n_inters):
+    users = torch.randint(0, n_users, (n_inters,))
+    items = torch.randint(0, n_items, (n_inters,)) + n_users
+    edge_index = torch.stack((users, items))
+    return torch.cat((edge_index, edge_index[[1, 0]]), dim=1)
+
+
+def timeit(fn, repeat):
+    fn()
+    start = time()
+    for _ in range(repeat):
+        out = fn()
+    return (time() - start) / repeat, out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--items', type=int, default=7000)
+    parser.add_argument('--inters', type=int, default=160000)
+    parser.add_argument('--dim', type=int, default=128, help='channels, 128 = fused visual + textual towers')
+    parser.add_argument('--repeat', type=int, default=20)
+    args, _ = parser.parse_known_args()
+
+    num_nodes = args.users + args.items
+    edge_index = random_edge_index(args.users, args.items, args.inters)
+    x = torch.randn(num_nodes, args.dim)
+    conv = Base_gcn(args.dim, args.dim)
+
+    start = time()
+    adj = to_csr(build_norm_adj(edge_index, num_nodes))
+    build_time = time() - start
+
+    mp_time, mp_out = timeit(lambda: conv(x, edge_index), args.repeat)
+    spmm_time, spmm_out = timeit(lambda: conv(x, adj), args.repeat)
+    print('nodes: {}, edges: {}, dim: {}, adjacency layout: {}'.format(
+        num_nodes, edge_index.shape[1], args.dim, adj.layout))
+    print('build adjacency (once): {:.2f}ms'.format(build_time * 1000))
+    print('MessagePassing: {:.2f}ms/layer'.format(mp_time * 1000))
+    print('SpMM:           {:.2f}ms/layer ({:.1f}x)'.format(spmm_time * 1000, mp_time / spmm_time))
+    print('max abs diff:   {:.2e}'.format((mp_out - spmm_out).abs().max().item()))
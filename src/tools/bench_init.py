@@ -0,0 +1,57 @@
+# coding: utf-8
+"""
+Benchmark the modality-drop edge construction of SEA.__init__ at several catalog sizes:
+the former per-item python loop against the vectorized drop_item_edges.
+
+    python tools/bench_init.py --items 1000 10000 100000 --loop_limit 20000
+"""
+import os
+import sys
+import argparse
+from time import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.SEA import drop_item_edges
+
+
+def loop_drop_item_edges(edge_index, num_user, num_item, drop_items):
+    # construction used before drop_item_edges, O(n_items x n_dropped)
+    mask_cnt = [0] * num_item
+    for edge in edge_index:
+        mask_cnt[edge[1] - num_user] += 1
+    mask = []
+    for idx, num in enumerate(mask_cnt):
+        mask.extend([False] * num) if idx in drop_items else mask.extend([True] * num)
+    edge_index = edge_index[np.lexsort(edge_index.T[1, None])]
+    return edge_index[mask]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--users_per_item', type=float, default=2.5)
+    parser.add_argument('--inters_per_item', type=int, default=20)
+    parser.add_argument('--drop_rate', type=float, default=0.1)
+    parser.add_argument('--loop_limit', type=int, default=20000, help='largest catalog timed with the python loop')
+    args, _ = parser.parse_known_args()
+
+    for num_item in args.items:
+        num_user = int(num_item * args.users_per_item)
+        n_inters = num_item * args.inters_per_item
+        edge_index = np.column_stack((np.random.randint(0, num_user, n_inters),
+                                      np.random.randint(0, num_item, n_inters) + num_user))
+        drop_items = np.random.choice(num_item, int(num_item * args.drop_rate / 3), replace=False)
+
+        start = time()
+        kept = drop_item_edges(edge_index, num_user, drop_items)
+        vec_time = time() - start
+        line = 'items: {:>8d}, edges: {:>9d}, vectorized: {:9.2f}ms'.format(num_item, n_inters, vec_time * 1000)
+        if num_item <= args.loop_limit:
+            start = time()
+            ref = loop_drop_item_edges(edge_index, num_user, num_item, drop_items)
+            loop_time = time() - start
+            assert np.array_equal(ref, kept)
+            line += ', python loop: {:9.2f}ms ({:.0f}x)'.format(loop_time * 1000, loop_time / max(vec_time, 1e-9))
+        print(line)
@@ -0,0 +1,69 @@
+# coding: utf-8
+"""
+Benchmark negative sampling of TrainDataLoader: the former per-user python loop
+(random.sample on the item list, retries against a set) against the vectorized
+sample_negatives over sorted history keys. Reports negatives/s and the sampling time of
+one epoch, to compare with the training step time of the model.
+
+    python tools/bench_neg_sampling.py --users 20000 --items 7000 --inters 160000
+"""
+import os
+import sys
+import random
+import argparse
+from time import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.dataloader import sample_negatives
+
+
+def loop_sample_negatives(u_ids, history_items_per_u, all_items):
+    # sampler used before sample_negatives
+    neg_ids = []
+    for u in u_ids:
+        iid = random.sample(all_items, 1)[0]
+        while iid in history_items_per_u[u]:
+            iid = random.sample(all_items, 1)[0]
+        neg_ids.append(iid)
+    return neg_ids
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--items', type=int, default=7000)
+    parser.add_argument('--inters', type=int, default=160000)
+    parser.add_argument('--batch_size', type=int, default=2048)
+    parser.add_argument('--batches', type=int, default=20)
+    args, _ = parser.parse_known_args()
+
+    users = np.random.randint(0, args.users, args.inters)
+    items = np.random.randint(0, args.items, args.inters)
+    history_keys = np.unique(users * args.items + items)
+    candidates = np.unique(items)
+    history_items_per_u = {}
+    for u, i in zip(users.tolist(), items.tolist()):
+        history_items_per_u.setdefault(u, set()).add(i)
+    all_items = candidates.tolist()
+    batches = [users[np.random.randint(0, args.inters, args.batch_size)] for _ in range(args.batches)]
+
+    start = time()
+    neg_ids = [sample_negatives(u_ids, history_keys, args.items, candidates) for u_ids in batches]
+    vec_time = (time() - start) / args.batches
+    # checked outside of the timed loop
+    for u_ids, neg in zip(batches, neg_ids):
+        assert not np.isin(u_ids * args.items + neg, history_keys).any()
+    start = time()
+    for u_ids in batches:
+        loop_sample_negatives(u_ids.tolist(), history_items_per_u, all_items)
+    loop_time = (time() - start) / args.batches
+
+    n_batches = -(-args.inters // args.batch_size)
+    print('users: {}, items: {}, interactions: {}, batch: {}'.format(
+        args.users, args.items, args.inters, args.batch_size))
+    for name, t in (('python loop', loop_time), ('vectorized', vec_time)):
+        print('{:<12} {:8.3f}ms/batch, {:12.0f} negatives/s, {:8.2f}s/epoch'.format(
+            name, t * 1000, args.batch_size / t, t * n_batches))
+    print('speedup: {:.0f}x'.format(loop_time / max(vec_time, 1e-9)))
@@ -0,0 +1,78 @@
+# coding: utf-8
+"""
+Approximate nearest neighbors for the item-item kNN graph
+##########################
+"""
+
+import torch
+from utils.utils import blockwise_knn
+
+
+def lsh_knn(embeddings, topk, n_tables=8, window=64, n_bits=16, memory_budget=256 * 2 ** 20):
+    r""" approximate cosine top-k neighbors with sorted random-projection LSH
+
+    Every table hashes the items with ``n_bits`` random hyperplanes and sorts them by their code, so
+    items with similar codes sit next to each other. The candidates of an item are the ``window``
+    items around it in every table; exact cosine similarities are only computed for those.
+    Building costs ``O(n_tables * N log N)`` for the sorts plus ``O(N * n_tables * window * D)``.
+
+    Args:
+        embeddings (torch.Tensor): item features, shape: [N, D]
+        topk (int): neighbors per row
+        n_tables (int): hash tables, more tables give higher recall
+        window (int): candidates per item and table, larger windows give higher recall
+        n_bits (int): hyperplanes per table, at most 62
+        memory_budget (int): bytes allowed for the gathered candidates of one row block
+
+    Returns:
+        torch.Tensor: neighbor ids sorted by similarity, shape: [N, topk]
+    """
+    n, dim = embeddings.shape
+    if n <= window:
+        return blockwise_knn(embeddings, topk, memory_budget)
+    device = embeddings.device
+    context_norm = embeddings.div(torch.norm(embeddings, p=2, dim=-1, keepdim=True))
+
+    weights = 2 ** torch.arange(n_bits - 1, -1, -1, device=device)
+    positions = torch.arange(n, device=device)
+    orders, ranks = [], []
+    for _ in range(n_tables):
+        planes = torch.randn(dim, n_bits, dtype=context_norm.dtype, device=device)
+        code = ((context_norm @ planes > 0).long() * weights).sum(dim=1)
+        order = torch.argsort(code)
+        rank = torch.empty_like(order)
+        rank[order] = positions
+        orders.append(order)
+        ranks.append(rank)
+
+    offsets = torch.arange(-(window // 2), window - window // 2, device=device)
+    row_block = max(1, int(memory_budget // (n_tables * window * dim * context_norm.element_size())))
+    knn_ind = torch.empty(n, topk, dtype=torch.long, device=device)
+    for start in range(0, n, row_block):
+        rows = positions[start:start + row_block]
+        cand = torch.cat([order[(rank[rows][:, None] + offsets).clamp(0, n - 1)]
+                          for order, rank in zip(orders, ranks)], dim=1)
+        cand, _ = torch.sort(cand, dim=1)
+        sim = torch.bmm(context_norm[cand], context_norm[rows][:, :, None]).squeeze(-1)
+        # the same candidate can come from several tables
+        sim[:, 1:][cand[:, 1:] == cand[:, :-1]] = float('-inf')
+        _, pos = torch.topk(sim, topk, dim=-1)
+        knn_ind[start:start + row_block] = torch.gather(cand, 1, pos)
+    return knn_ind
+
+
+def knn_recall(embeddings, knn_ind, sample_size=1000, memory_budget=256 * 2 ** 20):
+    r""" recall of ``knn_ind`` against the exact cosine top-k on a random sample of rows
+
+    Args:
+        embeddings (torch.Tensor): item features, shape: [N, D]
+        knn_ind (torch.Tensor): approximate neighbors, shape: [N, topk]
+        sample_size (int): rows checked against the exact search
+
+    Returns:
+        float: mean fraction of the exact neighbors that ``knn_ind`` found
+    """
+    rows = torch.randperm(knn_ind.shape[0], device=knn_ind.device)[:sample_size]
+    exact = blockwise_knn(embeddings, knn_ind.shape[1], memory_budget, rows=rows)
+    hit = (exact[:, :, None] == knn_ind[rows][:, None, :]).any(dim=-1)
+    return hit.float().mean().item()
@@ -0,0 +1,118 @@
+# coding: utf-8
+"""
+Content-addressed cache of graph artifacts
+##########################
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import torch
+
+
+def file_digest(path, chunk_size=2 ** 20):
+    r""" sha1 of a file's content, read in chunks
+
+    Args:
+        path (str): file path
+
+    Returns:
+        str: hex digest
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ArtifactCache(object):
+    r"""On-disk cache of tensors keyed by a hash of everything they were built from.
+
+    Every entry is a directory holding one ``.npy`` file per dense array and a ``meta.json`` that
+    records how to rebuild sparse COO/CSR tensors. Arrays are opened with ``mmap_mode``, so loading
+    an entry does not read it into memory and pages are only materialized when first touched.
+
+    Args:
+        cache_dir (str): directory of the cache entries
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def key(self, name, *parts):
+        r"""Build the key of an artifact.
+
+        Args:
+            name (str): artifact name, used as prefix of the key
+            parts: anything the artifact depends on; arrays and tensors are hashed by content
+
+        Returns:
+            str: cache key
+        """
+        sha = hashlib.sha1(name.encode())
+        for part in parts:
+            if torch.is_tensor(part):
+                part = part.detach().cpu().numpy()
+            if isinstance(part, np.ndarray):
+                sha.update('{}{}'.format(part.dtype, part.shape).encode())
+                sha.update(np.ascontiguousarray(part).tobytes())
+            else:
+                sha.update(repr(part).encode())
+        return '{}-{}'.format(name, sha.hexdigest()[:20])
+
+    def get_or_build(self, key, build):
+        r"""Load the artifact ``key``, or build it with ``build()`` and store it.
+
+        Args:
+            key (str): cache key from :meth:`key`
+            build (callable): returns a dict of name -> tensor (dense, sparse COO or sparse CSR)
+
+        Returns:
+            dict: name -> tensor
+        """
+        path = os.path.join(self.cache_dir, key)
+        if os.path.isfile(os.path.join(path, 'meta.json')):
+            return self.load(path)
+        tensors = build()
+        self.save(path, tensors)
+        return tensors
+
+    def load(self, path):
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        tensors = {}
+        for name, info in meta.items():
+            parts = {p: torch.from_numpy(np.load(os.path.join(path, '{}.{}.npy'.format(name, p)), mmap_mode='c'))
+                     for p in info['parts']}
+            if info['layout'] == 'coo':
+                tensors[name] = torch.sparse_coo_tensor(parts['indices'], parts['values'], info['shape'])
+            elif info['layout'] == 'csr':
+                tensors[name] = torch.sparse_csr_tensor(parts['crow'], parts['col'], parts['values'], info['shape'])
+            else:
+                tensors[name] = parts['data']
+        return tensors
+
+    def save(self, path, tensors):
+        # write into a temporary directory first so that a crash never leaves a half-written entry
+        tmp_path = path + '.tmp{}'.format(os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+        meta = {}
+        for name, tensor in tensors.items():
+            if tensor.layout == torch.sparse_coo:
+                layout, parts = 'coo', {'indices': tensor._indices(), 'values': tensor._values()}
+            elif tensor.layout == torch.sparse_csr:
+                layout, parts = 'csr', {'crow': tensor.crow_indices(), 'col': tensor.col_indices(),
+                                        'values': tensor.values()}
+            else:
+                layout, parts = 'dense', {'data': tensor}
+            for p, data in parts.items():
+                np.save(os.path.join(tmp_path, '{}.{}.npy'.format(name, p)), data.detach().cpu().numpy())
+            meta[name] = {'layout': layout, 'shape': list(tensor.shape), 'parts': list(parts)}
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        if os.path.isdir(path):
+            shutil.rmtree(tmp_path)
+        else:
+            os.rename(tmp_path, path)
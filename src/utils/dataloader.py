@@ -8,10 +8,41 @@ import math
 import torch
 import random
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
 from scipy.sparse import coo_matrix
 
 
+def sample_negatives(u_ids, history_keys, item_num, candidates, rng=None):
+    r"""Draw one negative item per user, uniformly among ``candidates`` outside the user's history.
+
+    The whole batch is drawn at once; slots that hit the history are found with one ``searchsorted``
+    and only those are drawn again.
+
+    Args:
+        u_ids (numpy.ndarray): user ids, shape: [batch]
+        history_keys (numpy.ndarray): sorted ``user * item_num + item`` of all training interactions,
+            i.e. the sorted CSR rows of the histories laid end to end
+        item_num (int): number of items
+        candidates (numpy.ndarray): item ids to draw from
+        rng (numpy.random.Generator): random generator, ``None`` for the global numpy state
+
+    Returns:
+        numpy.ndarray: negative item ids, shape: [batch]
+    """
+    draw = rng.integers if rng is not None else np.random.randint
+    u_ids = np.asarray(u_ids, dtype=np.int64)
+    neg_ids = candidates[draw(len(candidates), size=len(u_ids))]
+    redraw = np.arange(len(u_ids))
+    while redraw.shape[0] > 0:
+        keys = u_ids[redraw] * item_num + neg_ids[redraw]
+        pos = np.minimum(np.searchsorted(history_keys, keys), len(history_keys) - 1)
+        redraw = redraw[history_keys[pos] == keys]
+        neg_ids[redraw] = candidates[draw(len(candidates), size=len(redraw))]
+    return neg_ids
+
+
 class AbstractDataLoader(object):
     """:class:`AbstractDataLoader` is an abstract object which would return a batch of data which is loaded by
     :class:`~recbole.data.interaction.Interaction` when it is iterated.
@@ -130,6 +161,26 @@ class TrainDataLoader(AbstractDataLoader):
             self.sample_func = self._get_non_neg_sample
 
         self._get_history_items_u()
+        # histories as sorted user * item_num + item keys, for the vectorized negative sampler
+        users = self.dataset.df[self.dataset.uid_field].values.astype(np.int64)
+        items = self.dataset.df[self.dataset.iid_field].values.astype(np.int64)
+        self.history_keys = np.unique(users * self.dataset.item_num + items)
+        self.all_items_array = np.unique(items)
+        # training interactions as contiguous int32 columns, an epoch gathers them once in permuted
+        # order and every batch is a slice (view) of the gathered columns
+        self.user_column = np.ascontiguousarray(users, dtype=np.int32)
+        self.item_column = np.ascontiguousarray(items, dtype=np.int32)
+        self.epoch_users, self.epoch_items = self.user_column, self.item_column
+        # every batch draws from its own generator seeded by (epoch seed, batch index), so batches do not
+        # depend on the order they are built in; prefetch_batches > 0 builds them ahead in worker threads
+        self.epoch_seed = 0
+        self.batch_idx = 0
+        self.prefetch_batches = config['prefetch_batches'] or 0
+        # negatives per positive, rows 2 .. 2 + neg_sample_num of a batch; none with in-batch negatives,
+        # the model then uses the positives of the other users of the batch
+        self.neg_sample_num = 0 if config['in_batch_negatives'] else config['training_neg_sample_num'] or 1
+        self.prefetch_queue = deque()
+        self.prefetch_pool = ThreadPoolExecutor(config['prefetch_workers'] or 1) if self.prefetch_batches else None
         self.neighborhood_loss_required = config['use_neighborhood_loss']
         if self.neighborhood_loss_required:
             self.history_users_per_i = {}
@@ -142,13 +193,10 @@ class TrainDataLoader(AbstractDataLoader):
         Reset dataloader. Outputing the same positive & negative samples with each training.
         :return:
         """
-        # sort & random
-        if self.shuffle:
-            self.dataset = self.dataset_bk.copy(self.dataset_bk.df)
-        self.all_items.sort()
+        # sort & random; negatives are drawn from all_items_array, so all_items keeps its order
+        self.epoch_users, self.epoch_items = self.user_column, self.item_column
         if self.use_full_sampling:
             self.all_uids.sort()
-        random.shuffle(self.all_items)
         # reorder dataset as default (chronological order)
         #self.dataset.sort_by_chronological()
 
@@ -216,63 +264,98 @@ class TrainDataLoader(AbstractDataLoader):
         return len(self.dataset)
 
     def _shuffle(self):
-        self.dataset.shuffle()
+        order = np.random.permutation(len(self.user_column))
+        self.epoch_users, self.epoch_items = self.user_column[order], self.item_column[order]
         if self.use_full_sampling:
             np.random.shuffle(self.all_uids)
 
+    def __iter__(self):
+        if self.prefetch_queue:
+            # previous epoch was interrupted
+            for future in self.prefetch_queue:
+                future.cancel()
+            self.prefetch_queue.clear()
+            self.pr = 0
+        super().__iter__()
+        self.epoch_seed = np.random.randint(2 ** 31)
+        self.batch_idx = 0
+        if self.prefetch_batches:
+            self._fill_prefetch()
+        return self
+
+    def __next__(self):
+        if not self.prefetch_batches:
+            return super().__next__()
+        if not self.prefetch_queue:
+            self.pr = 0
+            self.inter_pr = 0
+            raise StopIteration()
+        batch = self.prefetch_queue.popleft().result()
+        self._fill_prefetch()
+        return batch
+
+    def _fill_prefetch(self):
+        while len(self.prefetch_queue) < self.prefetch_batches and self.pr < self.pr_end:
+            args = self._next_batch_args()
+            self.prefetch_queue.append(self.prefetch_pool.submit(self.sample_func, *args))
+
+    def _next_batch_args(self):
+        # views of the epoch columns for the current batch and its seed, the batch is built by sample_func
+        start, end = self.pr, self.pr + self.step
+        self.pr = end
+        seed = (self.epoch_seed, self.batch_idx)
+        self.batch_idx += 1
+        if self.sample_func == self._get_full_uids_sample:
+            return self.all_uids[start:end], seed
+        return self.epoch_users[start:end], self.epoch_items[start:end], seed
+
     def _next_batch_data(self):
-        return self.sample_func()
+        return self.sample_func(*self._next_batch_args())
 
-    def _get_neg_sample(self):
-        cur_data = self.dataset[self.pr: self.pr + self.step]
-        self.pr += self.step
+    def _get_neg_sample(self, u_ids, i_ids, seed):
+        rng = np.random.default_rng(seed)
         # to tensor
-        user_tensor = torch.tensor(cur_data[self.config['USER_ID_FIELD']].values).type(torch.LongTensor).to(self.device)
-        item_tensor = torch.tensor(cur_data[self.config['ITEM_ID_FIELD']].values).type(torch.LongTensor).to(self.device)
+        user_tensor = torch.from_numpy(u_ids).long().to(self.device)
+        item_tensor = torch.from_numpy(i_ids).long().to(self.device)
         batch_tensor = torch.cat((torch.unsqueeze(user_tensor, 0),
                                   torch.unsqueeze(item_tensor, 0)))
-        u_ids = cur_data[self.config['USER_ID_FIELD']]
         # sampling negative items only in the dataset (train)
-        neg_ids = self._sample_neg_ids(u_ids).to(self.device)
+        neg_ids = self._sample_neg_ids(u_ids, rng).to(self.device)
         # for neighborhood loss
         if self.neighborhood_loss_required:
-            i_ids = cur_data[self.config['ITEM_ID_FIELD']]
-            pos_neighbors, neg_neighbors = self._get_neighborhood_samples(i_ids, self.config['ITEM_ID_FIELD'])
+            i_ids = i_ids.tolist()
+            pos_neighbors, neg_neighbors = self._get_neighborhood_samples(
+                i_ids, self.config['ITEM_ID_FIELD'], random.Random(int(rng.integers(2 ** 62))))
             pos_neighbors, neg_neighbors = pos_neighbors.to(self.device), neg_neighbors.to(self.device)
 
-            batch_tensor = torch.cat((batch_tensor, neg_ids.unsqueeze(0),
+            batch_tensor = torch.cat((batch_tensor, neg_ids,
                                       pos_neighbors.unsqueeze(0), neg_neighbors.unsqueeze(0)))
 
         # merge negative samples
         else:
-            batch_tensor = torch.cat((batch_tensor, neg_ids.unsqueeze(0)))
+            batch_tensor = torch.cat((batch_tensor, neg_ids))
 
         return batch_tensor
 
-    def _get_non_neg_sample(self):
-        cur_data = self.dataset[self.pr: self.pr + self.step]
-        self.pr += self.step
+    def _get_non_neg_sample(self, u_ids, i_ids, seed):
         # to tensor
-        user_tensor = torch.tensor(cur_data[self.config['USER_ID_FIELD']].values).type(torch.LongTensor).to(self.device)
-        item_tensor = torch.tensor(cur_data[self.config['ITEM_ID_FIELD']].values).type(torch.LongTensor).to(self.device)
+        user_tensor = torch.from_numpy(u_ids).long().to(self.device)
+        item_tensor = torch.from_numpy(i_ids).long().to(self.device)
         batch_tensor = torch.cat((torch.unsqueeze(user_tensor, 0),
                                   torch.unsqueeze(item_tensor, 0)))
         return batch_tensor
 
-    def _get_full_uids_sample(self):
-        user_tensor = torch.tensor(self.all_uids[self.pr: self.pr + self.step]).type(torch.LongTensor).to(self.device)
-        self.pr += self.step
+    def _get_full_uids_sample(self, u_ids, seed):
+        user_tensor = torch.tensor(u_ids).type(torch.LongTensor).to(self.device)
         return user_tensor
 
-    def _sample_neg_ids(self, u_ids):
-        neg_ids = []
-        for u in u_ids:
-            # random 1 item
-            iid = self._random()
-            while iid in self.history_items_per_u[u]:
-                iid = self._random()
-            neg_ids.append(iid)
-        return torch.tensor(neg_ids).type(torch.LongTensor)
+    def _sample_neg_ids(self, u_ids, rng=None):
+        # shape: [neg_sample_num, batch]
+        if self.neg_sample_num == 0:
+            return torch.empty((0, len(u_ids)), dtype=torch.long)
+        neg_ids = sample_negatives(np.tile(u_ids, self.neg_sample_num), self.history_keys, self.dataset.item_num,
+                                   self.all_items_array, rng)
+        return torch.from_numpy(neg_ids.reshape(self.neg_sample_num, -1))
 
     def _get_my_neighbors(self, id_str):
         ret_dict = {}
@@ -286,7 +369,7 @@ class TrainDataLoader(AbstractDataLoader):
             ret_dict[i] = k
         return ret_dict
 
-    def _get_neighborhood_samples(self, ids, id_str):
+    def _get_neighborhood_samples(self, ids, id_str, rng=random):
         a2a_dict = self.user_user_dict if id_str == self.config['USER_ID_FIELD'] else self.item_item_dict
         all_set = self.all_users_set if id_str == self.config['USER_ID_FIELD'] else self.all_items_set
         pos_ids, neg_ids = [], []
@@ -296,18 +379,14 @@ class TrainDataLoader(AbstractDataLoader):
                 pos_ids.append(0)
                 neg_ids.append(0)
                 continue
-            pos_id = random.sample(pos_ids_my, 1)[0]
+            pos_id = rng.sample(pos_ids_my, 1)[0]
             pos_ids.append(pos_id)
-            neg_id = random.sample(all_set, 1)[0]
+            neg_id = rng.sample(all_set, 1)[0]
             while neg_id in pos_ids_my:
-                neg_id = random.sample(all_set, 1)[0]
+                neg_id = rng.sample(all_set, 1)[0]
             neg_ids.append(neg_id)
         return torch.tensor(pos_ids).type(torch.LongTensor), torch.tensor(neg_ids).type(torch.LongTensor)
 
-    def _random(self):
-        rd_id = random.sample(self.all_items, 1)[0]
-        return rd_id
-
     def _get_history_items_u(self):
         uid_field = self.dataset.uid_field
         iid_field = self.dataset.iid_field
@@ -0,0 +1,107 @@
+# coding: utf-8
+"""
+Compressed storage of frozen item features
+##########################
+"""
+
+import torch
+import torch.nn.functional as F
+
+
+class QuantizedFeatures(object):
+    r"""Frozen feature matrix stored as float16, or as int8 with one float32 scale per row.
+
+    Rows are dequantized ``block_size`` at a time by :meth:`linear`, so a full float32 copy of the
+    features never exists, neither in the forward pass nor in the saved tensors of the backward pass.
+
+    Args:
+        data (torch.Tensor): float16 or int8 rows, shape: [n_rows, dim]
+        scale (torch.Tensor): float32 scale of every int8 row, ``None`` for float16, shape: [n_rows]
+        block_size (int): rows dequantized at once
+    """
+    def __init__(self, data, scale=None, block_size=8192):
+        self.data = data
+        self.scale = scale
+        self.block_size = block_size
+
+    @classmethod
+    def quantize(cls, feat, dtype='int8', block_size=8192):
+        r"""Compress a float32 feature matrix.
+
+        Args:
+            feat (torch.Tensor): features, shape: [n_rows, dim]
+            dtype (str): 'fp16' or 'int8' (symmetric, per-row scale)
+            block_size (int): rows quantized and dequantized at once
+
+        Returns:
+            QuantizedFeatures
+        """
+        if dtype == 'fp16':
+            return cls(feat.half(), None, block_size)
+        if dtype != 'int8':
+            raise ValueError('unknown feature storage: {}'.format(dtype))
+        data = torch.empty(feat.shape, dtype=torch.int8, device=feat.device)
+        scale = feat.abs().amax(dim=1).clamp(min=1e-12) / 127.
+        for start in range(0, feat.shape[0], block_size):
+            end = start + block_size
+            data[start:end] = torch.round(feat[start:end] / scale[start:end, None]).to(torch.int8)
+        return cls(data, scale, block_size)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def device(self):
+        return self.data.device
+
+    def nbytes(self):
+        scale_bytes = 0 if self.scale is None else self.scale.numel() * self.scale.element_size()
+        return self.data.numel() * self.data.element_size() + scale_bytes
+
+    def __getitem__(self, rows):
+        return QuantizedFeatures(self.data[rows], None if self.scale is None else self.scale[rows], self.block_size)
+
+    def dequantize(self, start=0, end=None):
+        r"""float32 rows ``start:end``."""
+        block = self.data[start:end].float()
+        if self.scale is not None:
+            block = block * self.scale[start:end, None]
+        return block
+
+    def linear(self, layer):
+        r"""``layer(features)`` computed block by block.
+
+        Args:
+            layer (torch.nn.Linear): layer reading the features
+
+        Returns:
+            torch.Tensor: shape: [n_rows, layer.out_features]
+        """
+        return _DequantLinear.apply(layer.weight, layer.bias, self)
+
+
+class _DequantLinear(torch.autograd.Function):
+    r"""Linear layer over :class:`QuantizedFeatures`. The features are constant, so the backward pass
+    only needs them for the weight gradient and dequantizes them again block by block."""
+    @staticmethod
+    def forward(ctx, weight, bias, feat):
+        ctx.feat = feat
+        ctx.has_bias = bias is not None
+        ctx.save_for_backward(weight)
+        out = [F.linear(feat.dequantize(start, start + feat.block_size), weight, bias)
+               for start in range(0, feat.shape[0], feat.block_size)]
+        return torch.cat(out, dim=0)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        weight, = ctx.saved_tensors
+        feat = ctx.feat
+        # grad_out is bfloat16 when the forward pass ran under autocast
+        grad_out = grad_out.to(weight.dtype)
+        grad_weight = torch.zeros_like(weight)
+        for start in range(0, feat.shape[0], feat.block_size):
+            end = start + feat.block_size
+            grad_weight += grad_out[start:end].t() @ feat.dequantize(start, end)
+        grad_bias = grad_out.sum(dim=0) if ctx.has_bias else None
+        return grad_weight, grad_bias, None
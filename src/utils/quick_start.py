@@ -12,6 +12,7 @@ from utils.dataloader import TrainDataLoader, EvalDataLoader
 from utils.logger import init_logger
 from utils.configurator import Config
 from utils.utils import init_seed, get_model, get_trainer, dict2str
+from utils.user_graph import prepare_user_graph
 import platform
 import os
 import wandb
@@ -44,6 +45,9 @@ def quick_start(model, dataset, config_dict, args, save_model=True, mg=False):
         EvalDataLoader(config, valid_dataset, additional_dataset=train_dataset, batch_size=config['eval_batch_size']),
         EvalDataLoader(config, test_dataset, additional_dataset=train_dataset, batch_size=config['eval_batch_size']))
 
+    # preprocessing: user-user co-occurrence graph
+    prepare_user_graph(config, train_data)
+
     ############ Dataset loadded, run model
     hyper_ret = []
     val_metric = config['valid_metric'].lower()
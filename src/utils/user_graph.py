@@ -0,0 +1,167 @@
+# coding: utf-8
+"""
+User-user graph store
+##########################
+"""
+
+import os
+import hashlib
+from logging import getLogger
+from time import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+class UserGraph(object):
+    r"""User-user graph held as CSR arrays: the neighbors of user ``u`` are
+    ``indices[indptr[u]:indptr[u + 1]]`` with weights ``weights[indptr[u]:indptr[u + 1]]``,
+    ordered from the strongest to the weakest neighbor.
+
+    Args:
+        indptr (numpy.ndarray): row pointer, shape: [n_users + 1]
+        indices (numpy.ndarray): neighbor ids
+        weights (numpy.ndarray): neighbor weights, same shape as ``indices``
+    """
+    def __init__(self, indptr, indices, weights):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.weights = np.asarray(weights, dtype=np.float32)
+
+    @classmethod
+    def from_dict(cls, user_graph_dict):
+        r"""Convert the legacy ``{user: [neighbors, weights]}`` dict."""
+        rows = [user_graph_dict[i] for i in range(len(user_graph_dict))]
+        lengths = np.array([len(r[0]) for r in rows], dtype=np.int64)
+        indptr = np.concatenate(([0], np.cumsum(lengths)))
+        indices = np.concatenate([np.asarray(r[0], dtype=np.int64) for r in rows] + [np.zeros(0, dtype=np.int64)])
+        weights = np.concatenate([np.asarray(r[1], dtype=np.float32) for r in rows] + [np.zeros(0, dtype=np.float32)])
+        return cls(indptr, indices, weights)
+
+    @classmethod
+    def load(cls, path):
+        r"""Load a graph written by :meth:`save`."""
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['indptr'], data['indices'], data['weights'])
+
+    def save(self, path):
+        np.savez(path, indptr=self.indptr, indices=self.indices, weights=self.weights)
+
+    def __len__(self):
+        return self.indptr.shape[0] - 1
+
+    def topk_sample(self, k):
+        r"""Take the first ``k`` neighbors of every user.
+
+        Users with fewer than ``k`` neighbors are padded: padding slot ``p`` repeats a uniformly drawn
+        entry among the ``p`` entries before it. Users without neighbors get neighbor 0 with weight 0.
+
+        Args:
+            k (int): neighbors per user
+
+        Returns:
+            tuple:
+            - torch.Tensor, neighbor ids, shape: [n_users, k]
+            - torch.Tensor, softmax of the neighbor weights, shape: [n_users, k]
+        """
+        n = len(self)
+        slot = np.arange(k)
+        length = self.indptr[1:] - self.indptr[:-1]
+        empty = length == 0
+        take = np.maximum(np.minimum(length, k), 1)[:, None]
+
+        draws = (np.random.random_sample((n, k)) * slot).astype(np.int64)
+        src = np.where(slot < take, slot, draws)
+        # a drawn entry can itself be padding, follow it back to a real neighbor
+        padded = src >= take
+        while padded.any():
+            src = np.where(padded, np.take_along_axis(src, src, axis=1), src)
+            padded = src >= take
+
+        positions = np.where(empty[:, None], 0, self.indptr[:-1, None] + src)
+        if self.indices.shape[0] == 0:
+            return torch.zeros(n, k, dtype=torch.long), torch.zeros(n, k)
+        user_graph_index = torch.from_numpy(np.where(empty[:, None], 0, self.indices[positions]))
+        user_weight_matrix = F.softmax(torch.from_numpy(self.weights[positions]), dim=1)
+        user_weight_matrix[torch.from_numpy(empty)] = 0.
+        return user_graph_index, user_weight_matrix
+
+
+def build_user_graph(inter_matrix, topk, chunk_size=4096):
+    r""" user-user co-occurrence graph: the ``topk`` users sharing the most items with every user
+
+    Co-interaction counts are computed as ``R[chunk] @ R.T`` for chunks of ``chunk_size`` users, so
+    memory is bounded by the co-occurrences of one chunk.
+
+    Args:
+        inter_matrix (scipy.sparse.spmatrix): training interactions, shape: [n_users, n_items]
+        topk (int): neighbors kept per user
+        chunk_size (int): users per sparse product
+
+    Returns:
+        UserGraph: neighbors ordered by decreasing count (ties by user id), weights are the counts
+    """
+    inter = inter_matrix.tocsr().astype(np.float32)
+    inter.sum_duplicates()
+    inter.data[:] = 1.
+    inter_t = inter.T.tocsr()
+    n_users = inter.shape[0]
+    lengths, indices, weights = [], [], []
+    for start in range(0, n_users, chunk_size):
+        co = (inter[start:start + chunk_size] @ inter_t).tocoo()
+        keep = co.row + start != co.col
+        row, col, count = co.row[keep], co.col[keep], co.data[keep]
+        order = np.lexsort((col, -count, row))
+        row, col, count = row[order], col[order], count[order]
+        row_len = np.bincount(row, minlength=co.shape[0])
+        rank = np.arange(row.shape[0]) - np.repeat(np.cumsum(row_len) - row_len, row_len)
+        top = rank < topk
+        lengths.append(np.minimum(row_len, topk))
+        indices.append(col[top].astype(np.int64))
+        weights.append(count[top])
+    indptr = np.concatenate(([0], np.cumsum(np.concatenate(lengths))))
+    return UserGraph(indptr, np.concatenate(indices), np.concatenate(weights))
+
+
+def user_graph_path(config, inter_matrix):
+    r""" path of the user-user graph built from ``inter_matrix``
+
+    ``user_graph_file`` is tagged with ``user_graph_topk`` and a digest of the training
+    interactions, so a graph of another split or another ``topk`` is never reused.
+
+    Args:
+        config (Config): needs ``data_path``, ``dataset``, ``user_graph_file`` and ``user_graph_topk``
+        inter_matrix (scipy.sparse.spmatrix): training interactions, shape: [n_users, n_items]
+
+    Returns:
+        str: graph file
+    """
+    inter = inter_matrix.tocsr()
+    inter.sum_duplicates()
+    sha = hashlib.sha1('{}'.format(inter.shape).encode())
+    sha.update(inter.indptr.astype(np.int64).tobytes())
+    sha.update(inter.indices.astype(np.int64).tobytes())
+    root, ext = os.path.splitext(config['user_graph_file'])
+    dataset_path = os.path.abspath(config['data_path'] + config['dataset'])
+    return os.path.join(dataset_path, '{}_top{}_{}{}'.format(root, config['user_graph_topk'],
+                                                             sha.hexdigest()[:12], ext))
+
+
+def prepare_user_graph(config, train_data):
+    r""" build the graph of :func:`user_graph_path` from the training interactions if it does not exist yet
+
+    Args:
+        config (Config): needs ``user_graph_file``, ``user_graph_topk`` and ``user_graph_chunk_size``
+        train_data (TrainDataLoader): training interactions
+    """
+    if not config['user_graph_file']:
+        return
+    inter_matrix = train_data.inter_matrix(form='csr')
+    graph_file = user_graph_path(config, inter_matrix)
+    if os.path.isfile(graph_file):
+        return
+    start = time()
+    user_graph = build_user_graph(inter_matrix, config['user_graph_topk'], config['user_graph_chunk_size'] or 4096)
+    user_graph.save(graph_file)
+    getLogger().info('user-user graph of {} users built in {:.2f}s: {}'.format(
+        len(user_graph), time() - start, graph_file))
@@ -11,6 +11,8 @@ import torch
 import importlib
 import datetime
 import random
+from contextlib import contextmanager
+from logging import getLogger
 
 
 def get_local_time():
@@ -181,4 +183,180 @@ def build_knn_normalized_graph(adj, topk, is_sparse, norm_type):
         return torch.sparse_coo_tensor(edge_index, edge_weight, adj.shape)
     else:
         weighted_adjacency_matrix = (torch.zeros_like(adj)).scatter_(-1, knn_ind, knn_val)
-        return get_dense_laplacian(weighted_adjacency_matrix, normalization=norm_type)
\ No newline at end of file
+        return get_dense_laplacian(weighted_adjacency_matrix, normalization=norm_type)
+
+############ Graph Sampling Utilities #########
+
+def build_csr(row, col, num_nodes):
+    r""" sort ``(row, col)`` edges by row into CSR arrays
+
+    Args:
+        row (torch.Tensor): row index of every edge
+        col (torch.Tensor): column index of every edge
+        num_nodes (int): number of rows
+
+    Returns:
+        tuple:
+        - torch.Tensor, row pointer, shape: [num_nodes + 1]
+        - torch.Tensor, column index sorted by row
+        - torch.Tensor, permutation that maps CSR positions to the input edge order
+    """
+    _, perm = torch.sort(row, stable=True)
+    rowptr = torch.zeros(num_nodes + 1, dtype=torch.long, device=row.device)
+    rowptr[1:] = torch.cumsum(torch.bincount(row, minlength=num_nodes), dim=0)
+    return rowptr, col[perm], perm
+
+
+def sample_neighbors(rowptr, col, seeds, fanout=None):
+    r""" gather the CSR rows of ``seeds`` without python loops
+
+    Rows longer than ``fanout`` are subsampled (with replacement) to ``fanout`` entries, and each kept
+    entry is scaled by ``row_len / fanout`` so that a sum over the row stays unbiased.
+
+    Args:
+        rowptr (torch.Tensor): CSR row pointer
+        col (torch.Tensor): CSR column index
+        seeds (torch.Tensor): rows to gather
+        fanout (int, optional): max entries per row, ``None`` keeps every entry
+
+    Returns:
+        tuple:
+        - torch.Tensor, positions of the gathered entries in ``col``
+        - torch.Tensor, the seed (row) of every gathered entry
+        - torch.Tensor, scale of every gathered entry
+    """
+    start = rowptr[seeds]
+    count = rowptr[seeds + 1] - start
+    kept = count.clamp(max=fanout) if fanout else count
+    owner = torch.repeat_interleave(torch.arange(seeds.shape[0], device=seeds.device), kept)
+    offset = torch.arange(owner.shape[0], device=seeds.device) - \
+        torch.repeat_interleave(torch.cumsum(kept, dim=0) - kept, kept)
+    row_len = count[owner]
+    if fanout:
+        sampled = row_len > fanout
+        offset[sampled] = (torch.rand(int(sampled.sum()), device=seeds.device) * row_len[sampled]).long()
+    scale = row_len.float() / kept[owner].float()
+    return start[owner] + offset, seeds[owner], scale
+
+
+def build_norm_adj(edge_index, num_nodes):
+    r""" symmetric normalized adjacency of ``edge_index`` as propagated by Base_gcn
+
+    ``adj[i, j] = deg(j)^-1/2 * deg(i)^-1/2`` for every edge ``j -> i`` (self loops removed), so that
+    ``torch.sparse.mm(adj, x)`` equals one Base_gcn message passing step.
+
+    Args:
+        edge_index (torch.Tensor): edges, shape: [2, num_edges]
+        num_nodes (int): number of nodes
+
+    Returns:
+        torch.Tensor: coalesced sparse COO matrix, shape: [num_nodes, num_nodes]
+    """
+    edge_index = edge_index[:, edge_index[0] != edge_index[1]]
+    row, col = edge_index[0], edge_index[1]
+    deg_inv_sqrt = torch.bincount(row, minlength=num_nodes).float().pow(-0.5)
+    values = deg_inv_sqrt[row] * deg_inv_sqrt[col]
+    return torch.sparse_coo_tensor(torch.stack((col, row)), values, (num_nodes, num_nodes)).coalesce()
+
+
+def to_csr(adj):
+    r""" convert a sparse COO matrix to CSR, keeping COO if this torch build cannot multiply CSR matrices
+
+    Args:
+        adj (torch.Tensor): sparse COO matrix
+
+    Returns:
+        torch.Tensor: sparse CSR (or the input COO) matrix
+    """
+    try:
+        csr = adj.to_sparse_csr()
+        torch.sparse.mm(csr, torch.zeros(adj.shape[1], 1, dtype=adj.dtype, device=adj.device))
+    except (AttributeError, RuntimeError, NotImplementedError):
+        return adj
+    return csr
+
+
+def blockwise_knn(embeddings, topk, memory_budget, rows=None):
+    r""" cosine top-k neighbors of every row without building the (N x N) similarity matrix
+
+    Rows and columns are processed in tiles that fit ``memory_budget`` bytes, and a running top-k
+    per row is merged with the top-k of every tile.
+
+    Args:
+        embeddings (torch.Tensor): item features, shape: [N, D]
+        topk (int): neighbors per row
+        memory_budget (int): bytes allowed for one similarity tile
+        rows (torch.Tensor, optional): only search the neighbors of these rows
+
+    Returns:
+        torch.Tensor: neighbor ids sorted by similarity, shape: [N or len(rows), topk]
+    """
+    context_norm = embeddings.div(torch.norm(embeddings, p=2, dim=-1, keepdim=True))
+    queries = context_norm if rows is None else context_norm[rows]
+    n = context_norm.shape[0]
+    tile = max(int(memory_budget // context_norm.element_size()), 1)
+    col_block = min(n, tile)
+    row_block = max(1, tile // col_block)
+    knn_ind = torch.empty(queries.shape[0], topk, dtype=torch.long, device=context_norm.device)
+    for start in range(0, queries.shape[0], row_block):
+        rows = queries[start:start + row_block]
+        best_val = rows.new_full((rows.shape[0], topk), float('-inf'))
+        best_ind = torch.zeros(rows.shape[0], topk, dtype=torch.long, device=rows.device)
+        for c_start in range(0, n, col_block):
+            sim = torch.mm(rows, context_norm[c_start:c_start + col_block].transpose(1, 0))
+            # only the top-k of the tile is merged, so the similarity tile is the one buffer of tile size
+            cand_val, cand_ind = torch.topk(sim, min(topk, sim.shape[1]), dim=-1)
+            del sim
+            best_val, pos = torch.topk(torch.cat((best_val, cand_val), dim=1), topk, dim=-1)
+            best_ind = torch.gather(torch.cat((best_ind, cand_ind + c_start), dim=1), 1, pos)
+        knn_ind[start:start + row_block] = best_ind
+    return knn_ind
+
+
+############ Compilation Utilities #########
+
+_compile_warm_up = {'active': False}
+
+
+@contextmanager
+def compile_warm_up():
+    r"""Calls of :func:`compile_fn` functions inside this block fall back to eager execution when the
+    compiled call fails. Outside of it, errors of compiled calls propagate."""
+    _compile_warm_up['active'] = True
+    try:
+        yield
+    finally:
+        _compile_warm_up['active'] = False
+
+
+def compile_fn(fn, name, mode=None):
+    r"""``torch.compile`` a function or bound ``forward``, falling back to eager execution for good
+    when compilation is unavailable or a compiled call fails during :func:`compile_warm_up`.
+
+    Args:
+        fn (callable): function to compile, e.g. ``module.forward``
+        name (str): name used in the fallback warning
+        mode (str): ``torch.compile`` mode, e.g. 'reduce-overhead' or 'max-autotune'
+
+    Returns:
+        callable: same signature as ``fn``
+    """
+    logger = getLogger()
+    if not hasattr(torch, 'compile'):
+        logger.warning('torch.compile is not available, {} runs eagerly'.format(name))
+        return fn
+    compiled = torch.compile(fn, mode=mode)
+    state = {'fn': compiled}
+
+    def call(*args, **kwargs):
+        if state['fn'] is fn:
+            return fn(*args, **kwargs)
+        if not _compile_warm_up['active']:
+            return compiled(*args, **kwargs)
+        try:
+            return compiled(*args, **kwargs)
+        except Exception as e:
+            logger.warning('compiling {} failed, falling back to eager: {}'.format(name, e))
+            state['fn'] = fn
+            return fn(*args, **kwargs)
+    return call